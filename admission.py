@@ -0,0 +1,195 @@
+import os
+import time
+import threading
+from contextlib import contextmanager
+from detectors import DETECTOR_POOL_SIZE
+
+# Frames admitted at once (running or waiting for a detector); beyond this requests are shed with 503
+ADMISSION_MAX_INFLIGHT = int(os.environ.get('ADMISSION_MAX_INFLIGHT', DETECTOR_POOL_SIZE * 4))
+
+# Longest a frame waits behind the same user's running frame before giving up
+ADMISSION_MAX_WAIT = float(os.environ.get('ADMISSION_MAX_WAIT', 10))
+
+# Seconds clients are asked to back off when shed
+ADMISSION_RETRY_AFTER = int(os.environ.get('ADMISSION_RETRY_AFTER', 1))
+
+# Threads serving requests in this process; gunicorn.conf exports its gthread count (0: no fixed pool)
+WORKER_THREADS = int(os.environ.get('GUNICORN_THREADS', 0))
+
+# Room streams and WebSockets each hold a thread for as long as they stay open. Together they may
+# use what is left after the DETECTOR_POOL_SIZE * 2 + 2 threads kept for frames, polls and health checks
+STREAM_MAX_CONNECTIONS = int(os.environ.get(
+    'STREAM_MAX_CONNECTIONS',
+    max(1, WORKER_THREADS - (DETECTOR_POOL_SIZE * 2 + 2)) if WORKER_THREADS else 100
+))
+
+# Optional request header: milliseconds the client is still willing to wait for this frame
+DEADLINE_HEADER = 'X-Deadline-Ms'
+
+class AdmissionError(Exception):
+    """A frame refused before inference, with the HTTP status to report"""
+
+    def __init__(self, message, status, retry_after=None):
+        super().__init__(message)
+        self.status = status
+        self.retry_after = retry_after
+
+class FrameTicket:
+    """A frame waiting for its user's running frame to finish"""
+    __slots__ = ('event', 'superseded')
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.superseded = False
+
+class UserSlot:
+    """Admission state of one user: at most one running frame and one waiting"""
+    __slots__ = ('running', 'waiting')
+
+    def __init__(self):
+        self.running = False
+        self.waiting = None
+
+def deadline_from_header(value, now=None):
+    """Absolute monotonic deadline from an X-Deadline-Ms value, or None"""
+    if value is None:
+        return None
+    try:
+        budget_ms = float(value)
+    except (TypeError, ValueError):
+        return None
+    return (now or time.monotonic()) + budget_ms / 1000.0
+
+def check_deadline(deadline):
+    """Drop work whose deadline has already passed"""
+    if deadline is not None and time.monotonic() > deadline:
+        raise AdmissionError('Deadline exceeded', 504)
+
+class AdmissionController:
+    """Latest-frame-wins per user plus a global in-flight limit"""
+
+    def __init__(self, max_inflight=ADMISSION_MAX_INFLIGHT):
+        self.max_inflight = max_inflight
+        self.inflight = 0
+        self.slots = {}
+        self._lock = threading.Lock()
+        self.counters = {'admitted': 0, 'superseded': 0, 'overloaded': 0, 'expired': 0, 'timed_out': 0}
+
+    def _enter(self, user_id):
+        """Reserve a global slot and queue behind the user's running frame; returns a ticket or None"""
+        with self._lock:
+            if self.inflight >= self.max_inflight:
+                self.counters['overloaded'] += 1
+                raise AdmissionError('Server overloaded', 503, ADMISSION_RETRY_AFTER)
+            self.inflight += 1
+
+            slot = self.slots.get(user_id)
+            if slot is None:
+                slot = self.slots[user_id] = UserSlot()
+            if not slot.running:
+                slot.running = True
+                return None
+
+            # Depth one: a newer frame replaces the one already waiting
+            if slot.waiting is not None:
+                slot.waiting.superseded = True
+                slot.waiting.event.set()
+            ticket = slot.waiting = FrameTicket()
+            return ticket
+
+    def _leave(self, user_id, ran):
+        with self._lock:
+            self.inflight -= 1
+            if not ran:
+                return
+            slot = self.slots[user_id]
+            if slot.waiting is not None:
+                # Hand the user's slot straight to the waiting frame
+                slot.waiting.event.set()
+                slot.waiting = None
+            else:
+                del self.slots[user_id]
+
+    def _settle(self, user_id, ticket, deadline):
+        """Decide, atomically with supersede and hand-off, what a frame does after waiting"""
+        with self._lock:
+            if ticket.superseded:
+                self.counters['superseded'] += 1
+                raise AdmissionError('Superseded by a newer frame', 429)
+            if ticket.event.is_set():
+                # Handed the user's slot by the frame that ran before it
+                return
+            # Still waiting: give up the waiting place so no frame hands the slot to us later
+            self.slots[user_id].waiting = None
+            if deadline is not None and time.monotonic() >= deadline:
+                self.counters['expired'] += 1
+                raise AdmissionError('Deadline exceeded', 504)
+            self.counters['timed_out'] += 1
+            raise AdmissionError("Timed out waiting for the user's previous frame", 503, ADMISSION_RETRY_AFTER)
+
+    @contextmanager
+    def admit(self, user_id, deadline=None):
+        """Run the body once this frame holds the user's slot; newer frames supersede it while waiting"""
+        if deadline is not None and time.monotonic() > deadline:
+            with self._lock:
+                self.counters['expired'] += 1
+            raise AdmissionError('Deadline exceeded', 504)
+        ticket = self._enter(user_id)
+        ran = False
+        try:
+            if ticket is not None:
+                timeout = ADMISSION_MAX_WAIT
+                if deadline is not None:
+                    timeout = min(timeout, max(0.0, deadline - time.monotonic()))
+                ticket.event.wait(timeout)
+                self._settle(user_id, ticket, deadline)
+
+            ran = True
+            try:
+                check_deadline(deadline)
+            except AdmissionError:
+                with self._lock:
+                    self.counters['expired'] += 1
+                raise
+
+            with self._lock:
+                self.counters['admitted'] += 1
+            yield
+        finally:
+            self._leave(user_id, ran)
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self.counters)
+            stats['inflight'] = self.inflight
+            stats['max_inflight'] = self.max_inflight
+        return stats
+
+class ConnectionLimiter:
+    """Caps the long-lived connections (room streams, WebSockets) open in this process"""
+
+    def __init__(self, max_connections=STREAM_MAX_CONNECTIONS):
+        self.max_connections = max_connections
+        self.open = 0
+        self.refused = 0
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """Take a connection slot; False when the process is at its limit"""
+        with self._lock:
+            if self.open >= self.max_connections:
+                self.refused += 1
+                return False
+            self.open += 1
+            return True
+
+    def release(self):
+        with self._lock:
+            self.open -= 1
+
+    def stats(self):
+        with self._lock:
+            return {'open': self.open, 'max_connections': self.max_connections, 'refused': self.refused}
+
+admission_controller = AdmissionController()
+connection_limiter = ConnectionLimiter()
@@ -1,60 +1,52 @@
 import math
+import time
 import numpy as np
 import cv2
-from PIL import Image, ImageStat
-import mediapipe as mp
+import logging
+from utils import downscale_image, FRAME_MAX_SIDE, LUMINANCE_MAX_SIDE
+from detectors import shared_detector
+from app_logging import user_debug_enabled
 
-# MediaPipe initialization
-mp_face_mesh = mp.solutions.face_mesh
-mp_face_detection = mp.solutions.face_detection
-mp_pose = mp.solutions.pose
+logger = logging.getLogger(__name__)
 
-face_mesh = mp_face_mesh.FaceMesh(
-    static_image_mode=False,
-    max_num_faces=1,
-    min_detection_confidence=0.5,
-    min_tracking_confidence=0.5
-)
-
-face_detection = mp_face_detection.FaceDetection(
-    model_selection=1,
-    min_detection_confidence=0.5
-)
-
-pose_detection = mp_pose.Pose(
-    static_image_mode=False,
-    model_complexity=1,
-    min_detection_confidence=0.5,
-    min_tracking_confidence=0.5
-)
-
-def analyze_image_brightness(image):
-    """Analyze image brightness using PIL"""
-    gray_image = image.convert('L')
-    stat = ImageStat.Stat(gray_image)
-    brightness = stat.mean[0]
+class LuminanceStats:
+    """Brightness (mean), contrast (standard deviation) and optional histogram of a grayscale plane"""
     
-    return brightness
+    def __init__(self, mean, std, histogram=None):
+        self.mean = mean
+        self.std = std
+        self.histogram = histogram
 
-def analyze_image_contrast(image):
-    """Analyze image contrast using PIL"""
-    gray_image = image.convert('L')
-    
-    hist = gray_image.histogram()
-    
-    pixel_count = sum(hist)
-    if pixel_count == 0:
-        return 0
+def compute_luminance_stats(gray, with_histogram=False):
+    """Compute luminance statistics of a grayscale array in a single vectorized pass"""
+    if gray.size == 0:
+        return LuminanceStats(0.0, 0.0, np.zeros(256, dtype=np.int64) if with_histogram else None)
     
-    mean_val = sum(i * hist[i] for i in range(256)) / pixel_count
-    variance = sum(((i - mean_val) ** 2) * hist[i] for i in range(256)) / pixel_count
-    contrast = math.sqrt(variance)
+    mean, std = cv2.meanStdDev(gray)
+    histogram = np.bincount(gray.ravel(), minlength=256) if with_histogram else None
     
-    return contrast
+    return LuminanceStats(float(mean[0][0]), float(std[0][0]), histogram)
 
-def detect_face_mediapipe(cv_image):
-    """Detect face using MediaPipe face detection"""
-    image_rgb = cv2.cvtColor(cv_image, cv2.COLOR_BGR2RGB)
+def compute_frame_signature(gray, size=16):
+    """Downsample a grayscale image to a size x size signature"""
+    return cv2.resize(gray, (size, size), interpolation=cv2.INTER_AREA)
+
+def frame_signature_distance(signature_a, signature_b):
+    """Mean absolute pixel difference between two signatures (0-255)"""
+    return cv2.norm(signature_a, signature_b, cv2.NORM_L1) / signature_a.size
+
+def analyze_image_brightness(frame):
+    """Analyze image brightness from the frame's luminance statistics"""
+    return frame.luminance.mean
+
+def analyze_image_contrast(frame):
+    """Analyze image contrast from the frame's luminance statistics"""
+    return frame.luminance.std
+
+def detect_face_mediapipe(cv_image, face_detection, image_rgb=None, image_shape=None):
+    """Detect face using MediaPipe face detection; the bbox is in image_shape pixels if given"""
+    if image_rgb is None:
+        image_rgb = cv2.cvtColor(cv_image, cv2.COLOR_BGR2RGB)
     results = face_detection.process(image_rgb)
     
     if not results.detections:
@@ -64,7 +56,7 @@ def detect_face_mediapipe(cv_image):
     confidence = detection.score[0]
     
     bbox = detection.location_data.relative_bounding_box
-    h, w, _ = cv_image.shape
+    h, w = (image_shape or cv_image.shape)[0:2]
     bbox_coords = {
         'xmin': int(bbox.xmin * w),
         'ymin': int(bbox.ymin * h),
@@ -74,9 +66,10 @@ def detect_face_mediapipe(cv_image):
     
     return bbox_coords, confidence
 
-def detect_face_mesh_mediapipe(cv_image):
+def detect_face_mesh_mediapipe(cv_image, face_mesh, image_rgb=None):
     """Detect face mesh using MediaPipe"""
-    image_rgb = cv2.cvtColor(cv_image, cv2.COLOR_BGR2RGB)
+    if image_rgb is None:
+        image_rgb = cv2.cvtColor(cv_image, cv2.COLOR_BGR2RGB)
     results = face_mesh.process(image_rgb)
     
     return results
@@ -84,7 +77,9 @@ def detect_face_mesh_mediapipe(cv_image):
 def detect_pose_mediapipe(cv_image):
     """Detect pose using MediaPipe"""
     image_rgb = cv2.cvtColor(cv_image, cv2.COLOR_BGR2RGB)
-    results = pose_detection.process(image_rgb)
+    # The Pose graph is only built the first time a feature asks for it
+    with shared_detector('pose') as pose_detection:
+        results = pose_detection.process(image_rgb)
     
     return results
 
@@ -162,15 +157,13 @@ def detect_head_orientation(face_landmarks, image_shape):
     
     return yaw, pitch, roll
 
-def detect_sleeping_state(face_landmarks, image_shape, eye_openness):
+def detect_sleeping_state(frame, eye_openness):
     """Detect if user is sleeping based on eye closure and head position"""
-    if not face_landmarks:
+    if not frame.face_landmarks:
         return False, 0.0
     
-    h, w = image_shape[0:2]
-    
     # Get head orientation
-    yaw, pitch, roll = detect_head_orientation(face_landmarks, image_shape)
+    yaw, pitch, roll = frame.head_orientation
     
     # Check for head dropping (forward tilt)
     head_dropping = pitch > 0.3  # Head tilted forward
@@ -200,15 +193,133 @@ def detect_sleeping_state(face_landmarks, image_shape, eye_openness):
     
     return is_sleeping, sleeping_score
 
-def analyze_face_present(pil_image, cv_image):
+class FrameAnalysis:
+    """Run MediaPipe once per frame and cache the results shared by all analyzers"""
+    
+    def __init__(self, cv_image, detectors=None, tracker=None, user_id=None):
+        # Inference runs on a downscaled copy; landmarks are normalized, so pixel
+        # measurements are still taken in the source resolution via image_shape
+        self.cv_image = downscale_image(cv_image, FRAME_MAX_SIDE)
+        self.image_shape = cv_image.shape
+        self.user_id = user_id
+        self.started_at = time.time()
+        # Per-frame measurement dumps are skipped entirely unless debug logging covers this user
+        self.debug = user_debug_enabled(logger, user_id)
+        self.face_detection_graph = None
+        self.detectors = None
+        self.tracker = None
+        if detectors is not None:
+            self.use_detectors(detectors, tracker)
+        self._gray = None
+        self._signature = None
+        self._luminance = None
+        self._image_rgb = None
+        self._face_detection = None
+        self._face_mesh_results = None
+        self._eye_aspect_ratios = None
+        self._head_orientation = None
+    
+    def use_detectors(self, detectors, tracker=None):
+        """Attach MediaPipe graphs; luminance and signature work without them"""
+        self.face_detection_graph = detectors.face_detection
+        self.detectors = detectors
+        self.tracker = tracker
+    
+    @property
+    def face_mesh_graph(self):
+        """The user's tracking mesh if a session is free, otherwise the pooled one; resolved when FaceMesh first runs"""
+        face_mesh = self.tracker.face_mesh if self.tracker is not None else None
+        return face_mesh or self.detectors.face_mesh
+    
+    @property
+    def gray(self):
+        """Small grayscale thumbnail, computed once per frame"""
+        if self._gray is None:
+            small = downscale_image(self.cv_image, LUMINANCE_MAX_SIDE, cv2.INTER_AREA)
+            self._gray = cv2.cvtColor(small, cv2.COLOR_BGR2GRAY)
+        return self._gray
+    
+    @property
+    def luminance(self):
+        """LuminanceStats of the grayscale thumbnail"""
+        if self._luminance is None:
+            self._luminance = compute_luminance_stats(self.gray)
+        return self._luminance
+    
+    @property
+    def signature(self):
+        """Tiny perceptual signature used to spot unchanged frames"""
+        if self._signature is None:
+            self._signature = compute_frame_signature(self.gray)
+        return self._signature
+    
+    @property
+    def image_rgb(self):
+        """RGB copy of the frame, converted once for both MediaPipe graphs"""
+        if self._image_rgb is None:
+            self._image_rgb = cv2.cvtColor(self.cv_image, cv2.COLOR_BGR2RGB)
+        return self._image_rgb
+    
+    @property
+    def face_detection(self):
+        """Face bounding box and confidence from MediaPipe face detection"""
+        if self._face_detection is None:
+            self._face_detection = detect_face_mediapipe(self.cv_image, self.face_detection_graph, self.image_rgb, self.image_shape)
+        return self._face_detection
+    
+    @property
+    def face_mesh_results(self):
+        """Raw MediaPipe face mesh results"""
+        if self._face_mesh_results is None:
+            self._face_mesh_results = detect_face_mesh_mediapipe(self.cv_image, self.face_mesh_graph, self.image_rgb)
+            if self.tracker is not None:
+                self.tracker.record_result(bool(self._face_mesh_results.multi_face_landmarks))
+        return self._face_mesh_results
+    
+    @property
+    def tracking_face(self):
+        """Whether the user's tracking mesh still followed a face in the previous frame"""
+        return self.tracker is not None and self.tracker.tracking_face
+    
+    @property
+    def face_landmarks(self):
+        """Landmarks of the first detected face, or None"""
+        results = self.face_mesh_results
+        if not results.multi_face_landmarks:
+            return None
+        return results.multi_face_landmarks[0]
+    
+    @property
+    def eye_aspect_ratios(self):
+        """Left and right Eye Aspect Ratio"""
+        if self._eye_aspect_ratios is None:
+            face_landmarks = self.face_landmarks
+            if face_landmarks is None:
+                self._eye_aspect_ratios = (0.0, 0.0)
+            else:
+                left_eye_landmarks, right_eye_landmarks = get_eye_landmarks(face_landmarks, [])
+                self._eye_aspect_ratios = (
+                    calculate_eye_aspect_ratio(left_eye_landmarks, self.image_shape),
+                    calculate_eye_aspect_ratio(right_eye_landmarks, self.image_shape)
+                )
+        return self._eye_aspect_ratios
+    
+    @property
+    def head_orientation(self):
+        """Head yaw, pitch and roll"""
+        if self._head_orientation is None:
+            self._head_orientation = detect_head_orientation(self.face_landmarks, self.image_shape)
+        return self._head_orientation
+
+def analyze_face_present(frame):
     """Analyze face presence and position with improved detection for looking away scenarios"""
-    face_bbox, confidence = detect_face_mediapipe(cv_image)
+    face_bbox, confidence = frame.face_detection
     
     # Also check face mesh detection as a backup
-    face_mesh_results = detect_face_mesh_mediapipe(cv_image)
+    face_landmarks = frame.face_landmarks
     mesh_confidence = 0.0
     
-    if face_mesh_results.multi_face_landmarks:
+    if face_landmarks:
         mesh_confidence = 0.8  # High confidence if face mesh is detected
     
     # Use the higher confidence between the two methods
@@ -218,8 +329,7 @@ def analyze_face_present(pil_image, cv_image):
     # If face mesh is detected but bbox is not, still consider face present
     if face_bbox is None and mesh_confidence > 0:
         # Create a synthetic bbox based on face mesh landmarks
-        face_landmarks = face_mesh_results.multi_face_landmarks[0]
-        h, w, _ = cv_image.shape
+        h, w, _ = frame.image_shape
         
         # Get bounding box from face mesh landmarks
         x_coords = [int(landmark.x * w) for landmark in face_landmarks.landmark]
@@ -240,7 +350,7 @@ def analyze_face_present(pil_image, cv_image):
     if face_bbox is None:
         return 0
     
-    h, w, _ = cv_image.shape
+    h, w, _ = frame.image_shape
     face_x = face_bbox['xmin'] + (face_bbox['width'] / 2)
     face_y = face_bbox['ymin'] + (face_bbox['height'] / 2)
     
@@ -253,9 +363,11 @@ def analyze_face_present(pil_image, cv_image):
     
     face_aspect_ratio = face_bbox['width'] / max(face_bbox['height'], 1)
     
-    print(f"  Face position: ({rel_x:.2f}, {rel_y:.2f}), distance from center: {center_distance:.2f}")
-    print(f"  Face size ratio: {face_size_ratio:.3f}, aspect ratio: {face_aspect_ratio:.2f}")
-    print(f"  Face detection confidence: {confidence:.2f}")
+    if frame.debug:
+        logger.debug(
+            "User %s - face position (%.2f, %.2f), center distance %.2f, size ratio %.3f, aspect ratio %.2f, confidence %.2f",
+            frame.user_id, rel_x, rel_y, center_distance, face_size_ratio, face_aspect_ratio, confidence
+        )
     
     adjusted_confidence = confidence
     
@@ -275,19 +387,12 @@ def analyze_face_present(pil_image, cv_image):
     
     return adjusted_confidence * 100
 
-def analyze_eye_area(pil_image, cv_image):
+def analyze_eye_area(frame):
     """Analyze eye openness and symmetry with improved drowsiness detection"""
-    face_mesh_results = detect_face_mesh_mediapipe(cv_image)
-    
-    if not face_mesh_results.multi_face_landmarks:
+    if not frame.face_landmarks:
         return 0
     
-    face_landmarks = face_mesh_results.multi_face_landmarks[0]
-    
-    left_eye_landmarks, right_eye_landmarks = get_eye_landmarks(face_landmarks, [])
-    
-    left_ear = calculate_eye_aspect_ratio(left_eye_landmarks, cv_image.shape)
-    right_ear = calculate_eye_aspect_ratio(right_eye_landmarks, cv_image.shape)
+    left_ear, right_ear = frame.eye_aspect_ratios
     
     eye_difference = abs(left_ear - right_ear)
     eye_difference_ratio = eye_difference / max(max(left_ear, right_ear), 0.01)
@@ -308,25 +413,24 @@ def analyze_eye_area(pil_image, cv_image):
     
     # Penalize asymmetric eyes (looking to the side)
     if eye_difference_ratio > 0.3:
-        print("  Detected asymmetric eyes - possibly looking to the side")
         openness_score = max(0, openness_score * 0.8)
     
-    print(f"  Left EAR: {left_ear:.3f}, Right EAR: {right_ear:.3f}, Avg: {avg_ear:.3f}")
-    print(f"  Eye difference ratio: {eye_difference_ratio:.3f}")
-    print(f"  Eye openness score: {openness_score:.1f}")
+    if frame.debug:
+        logger.debug(
+            "User %s - EAR left %.3f, right %.3f, avg %.3f, difference ratio %.3f%s, openness score %.1f",
+            frame.user_id, left_ear, right_ear, avg_ear, eye_difference_ratio,
+            " (asymmetric, possibly looking to the side)" if eye_difference_ratio > 0.3 else "",
+            openness_score
+        )
     
     return openness_score
 
-def analyze_head_position(pil_image, cv_image):
+def analyze_head_position(frame):
     """Analyze head position and orientation with improved looking away detection"""
-    face_mesh_results = detect_face_mesh_mediapipe(cv_image)
-    
-    if not face_mesh_results.multi_face_landmarks:
+    if not frame.face_landmarks:
         return 0.0
     
-    face_landmarks = face_mesh_results.multi_face_landmarks[0]
-    
-    yaw, pitch, roll = detect_head_orientation(face_landmarks, cv_image.shape)
+    yaw, pitch, roll = frame.head_orientation
     
     # Improved head position scoring with better thresholds for looking away detection
     # YAW factor (left-right rotation) - more sensitive to looking away
@@ -369,29 +473,25 @@ def analyze_head_position(pil_image, cv_image):
     if yaw_abs > 0.6 or pitch_abs > 0.6 or roll_abs > 45:
         looking_score *= 0.5  # Significant penalty for extreme positions
     
-    print(f"  Head position - yaw: {yaw:.2f}, pitch: {pitch:.2f}, roll: {roll:.2f}")
-    print(f"  Looking score: {looking_score:.2f}")
-    print(f"  Yaw factor: {yaw_factor:.2f}, Pitch factor: {pitch_factor:.2f}, Roll factor: {roll_factor:.2f}")
+    if frame.debug:
+        logger.debug(
+            "User %s - head yaw %.2f, pitch %.2f, roll %.2f, factors %.2f/%.2f/%.2f, looking score %.2f",
+            frame.user_id, yaw, pitch, roll, yaw_factor, pitch_factor, roll_factor, looking_score
+        )
     
     return looking_score
 
-def analyze_drowsiness(pil_image, cv_image):
+def analyze_drowsiness(frame):
     """Enhanced drowsiness detection combining multiple factors"""
-    face_mesh_results = detect_face_mesh_mediapipe(cv_image)
-    
-    if not face_mesh_results.multi_face_landmarks:
+    if not frame.face_landmarks:
         return 0.0
     
-    face_landmarks = face_mesh_results.multi_face_landmarks[0]
-    
     # Get eye openness
-    left_eye_landmarks, right_eye_landmarks = get_eye_landmarks(face_landmarks, [])
-    left_ear = calculate_eye_aspect_ratio(left_eye_landmarks, cv_image.shape)
-    right_ear = calculate_eye_aspect_ratio(right_eye_landmarks, cv_image.shape)
+    left_ear, right_ear = frame.eye_aspect_ratios
     avg_ear = (left_ear + right_ear) / 2
     
     # Get head orientation
-    yaw, pitch, roll = detect_head_orientation(face_landmarks, cv_image.shape)
+    yaw, pitch, roll = frame.head_orientation
     
     # Calculate drowsiness score based on multiple factors
     drowsiness_score = 0.0
@@ -441,7 +541,10 @@ def analyze_drowsiness(pil_image, cv_image):
     
     drowsiness_score += asymmetry_factor * 0.1
     
-    print(f"  Drowsiness analysis - EAR: {avg_ear:.3f}, pitch: {pitch:.2f}, roll: {roll:.2f}")
-    print(f"  Drowsiness score: {drowsiness_score:.2f}")
+    if frame.debug:
+        logger.debug(
+            "User %s - drowsiness EAR %.3f, pitch %.2f, roll %.2f, score %.2f",
+            frame.user_id, avg_ear, pitch, roll, drowsiness_score
+        )
     
     return drowsiness_score * 100 
\ No newline at end of file
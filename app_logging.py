@@ -0,0 +1,77 @@
+import os
+import sys
+import zlib
+import queue
+import atexit
+import logging
+import logging.handlers
+
+# Root log level, e.g. DEBUG to get per-frame measurement dumps
+LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO').upper()
+
+# Fraction of users (0-1) whose per-frame debug records are kept; the choice is stable per user
+LOG_USER_SAMPLE_RATE = float(os.environ.get('LOG_USER_SAMPLE_RATE', 1.0))
+
+# Records waiting for the writer thread; beyond this they are dropped instead of blocking requests
+LOG_QUEUE_SIZE = int(os.environ.get('LOG_QUEUE_SIZE', 10000))
+
+LOG_FORMAT = '%(asctime)s %(levelname)s [%(name)s] %(message)s'
+
+log_listener = None
+
+class NonBlockingQueueHandler(logging.handlers.QueueHandler):
+    """Queue handler that drops records when the writer falls behind"""
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+def is_user_sampled(user_id):
+    """Whether per-frame records are kept for this user"""
+    if LOG_USER_SAMPLE_RATE >= 1:
+        return True
+    if LOG_USER_SAMPLE_RATE <= 0:
+        return False
+    return zlib.crc32(str(user_id).encode()) % 10000 < LOG_USER_SAMPLE_RATE * 10000
+
+def user_debug_enabled(logger, user_id):
+    """Cheap check guarding per-frame debug dumps for a user"""
+    return logger.isEnabledFor(logging.DEBUG) and is_user_sampled(user_id)
+
+def configure_logging():
+    """Route all records through a bounded queue to a background writer thread"""
+    global log_listener
+
+    root = logging.getLogger()
+    root.setLevel(LOG_LEVEL)
+
+    # Once per process; a forked worker starts its own writer thread
+    if log_listener is not None and log_listener.pid == os.getpid():
+        return
+
+    stream_handler = logging.StreamHandler(sys.stdout)
+    stream_handler.setFormatter(logging.Formatter(LOG_FORMAT))
+
+    log_queue = queue.Queue(maxsize=LOG_QUEUE_SIZE)
+    for handler in list(root.handlers):
+        if isinstance(handler, NonBlockingQueueHandler):
+            root.removeHandler(handler)
+    root.addHandler(NonBlockingQueueHandler(log_queue))
+
+    log_listener = logging.handlers.QueueListener(log_queue, stream_handler, respect_handler_level=True)
+    log_listener.pid = os.getpid()
+    log_listener.start()
+    atexit.register(log_listener.stop)
+
+def get_dropped_log_count():
+    """Number of records dropped because the log queue was full"""
+    return sum(
+        handler.dropped for handler in logging.getLogger().handlers
+        if isinstance(handler, NonBlockingQueueHandler)
+    )
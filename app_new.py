@@ -1,19 +1,24 @@
 import os
 import sys
 import time
+import logging
 from routes import create_app
 
+logger = logging.getLogger(__name__)
+
 def main():
     """Main application entry point"""
-    print("Starting Attention Detection Server...")
-    print("Using Python version:", sys.version)
+    logger.info("Starting Attention Detection Server...")
+    logger.info("Using Python version: %s", sys.version)
     
     app = create_app()
     
     port = int(os.environ.get('PORT', 5000))
-    print(f"Server starting on port {port}")
+    logger.info("Server starting on port %d", port)
     
-    app.run(host='0.0.0.0', port=port, debug=True, threaded=True)
+    # Development server only; production runs under gunicorn (see gunicorn.conf.py)
+    debug = os.environ.get('FLASK_DEBUG', '0') == '1'
+    app.run(host='0.0.0.0', port=port, debug=debug, threaded=True)
 
 if __name__ == '__main__':
     main() 
\ No newline at end of file
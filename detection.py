@@ -1,250 +1,336 @@
+import os
 import time
+import logging
 import threading
-from collections import deque
 from models import (
     ATTENTIVE, LOOKING_AWAY, ABSENT, DROWSY, SLEEPING, DARKNESS,
-    UserAttentionData, UserCalibration
+    STAGE_LUMINANCE, STAGE_FACE_DETECTION, STAGE_LANDMARKS, STAGE_FRAME_CACHE,
+    Measurement, UserCalibration
 )
 from analysis import (
-    analyze_image_brightness, analyze_image_contrast,
+    FrameAnalysis, frame_signature_distance, analyze_image_brightness, analyze_image_contrast,
     analyze_face_present, analyze_eye_area, analyze_head_position,
-    analyze_drowsiness, detect_sleeping_state, detect_face_mesh_mediapipe
+    analyze_drowsiness, detect_sleeping_state
 )
+from detectors import detector_pool, tracker_sessions
+from rooms import room_registry, summarize_attention
+from admission import check_deadline
+from sampling import recommend_frame_interval
+from temporal import update_temporal_state, smoothed_measurement, get_perclos
 from utils import (
-    get_user_attention_data, get_user_calibration, set_user_calibration,
-    update_attention_history, get_attention_state_confidence
+    get_user_attention_data, save_user_attention_data, find_users_attention_data, set_user_room,
+    get_room_member_ids, is_state_shared, get_user_calibration, set_user_calibration,
+    update_attention_history, get_attention_state_confidence, get_user_lock
 )
 
-# Global processing lock for thread safety
-processing_lock = threading.Lock()
+logger = logging.getLogger(__name__)
 
-def calibrate_user(pil_image, cv_image, user_id):
+# Frame-difference skip cache: reuse the last result while the frame stays within
+# FRAME_SKIP_THRESHOLD (mean abs difference of 16x16 signatures, 0 disables), at most FRAME_SKIP_MAX_AGE seconds
+FRAME_SKIP_THRESHOLD = float(os.environ.get('FRAME_SKIP_THRESHOLD', 3.0))
+FRAME_SKIP_MAX_AGE = float(os.environ.get('FRAME_SKIP_MAX_AGE', 5.0))
+
+frame_cache_stats = {'hits': 0, 'misses': 0}
+frame_cache_stats_lock = threading.Lock()
+
+def calibrate_user(cv_image, user_id):
     """Calibrate user based on initial image"""
+    if get_user_calibration(user_id):
+        return False
+    
+    with get_user_lock(user_id):
+        with detector_pool.checkout() as detectors, tracker_sessions.checkout(user_id) as tracker:
+            return calibrate_from_frame(FrameAnalysis(cv_image, detectors, tracker, user_id), user_id)
+
+def calibrate_from_frame(frame, user_id):
+    """Calibrate user from an already analyzed frame"""
     calibration = get_user_calibration(user_id)
     if not calibration:
-        face_presence = analyze_face_present(pil_image, cv_image)
+        face_presence = analyze_face_present(frame)
         
         if face_presence > 20:
-            calibration_data = {
-                'brightness_baseline': analyze_image_brightness(pil_image),
-                'contrast_baseline': analyze_image_contrast(pil_image),
-                'time': time.time()
-            }
+            calibration_data = UserCalibration(user_id, frame.luminance.mean, frame.luminance.std)
             set_user_calibration(user_id, calibration_data)
             return True
     
     return False
 
-def detect_attention(pil_image, cv_image, user_id):
-    """Main attention detection function with enhanced detection"""
-    user_data = get_user_attention_data(user_id)
-    
-    if user_id not in user_data:
-        user_data[user_id] = {
-            'measurements': deque(maxlen=5),
-            'state_history': deque(maxlen=10),
-            'calibration_images': [],
-            'last_activity': time.time()
-        }
-        
-        calibrate_user(pil_image, cv_image, user_id)
+def detect_attention(frame, user_data):
+    """Main attention detection function, staged so cheap checks can decide before FaceMesh runs"""
+    user_id = user_data.user_id
     
-    brightness = analyze_image_brightness(pil_image)
-    print(f"DEBUG - User {user_id} - Brightness: {brightness:.2f}")
+    # Stage 1: luminance only
+    brightness = analyze_image_brightness(frame)
     
-    # Immediate darkness detection
     if brightness < 15:
-        print(f"DEBUG - User {user_id} - Detected DARKNESS (brightness < 15)")
-        return DARKNESS
+        if frame.debug:
+            logger.debug("User %s - brightness %.2f, detected DARKNESS (brightness < 15)", user_id, brightness)
+        user_data.add_measurement(Measurement(brightness, analyze_image_contrast(frame), 0, 0, 0.0))
+        user_data.add_state(DARKNESS)
+        return DARKNESS, STAGE_LUMINANCE
     
-    face_presence = analyze_face_present(pil_image, cv_image)
-    eye_openness = analyze_eye_area(pil_image, cv_image)
-    looking_score = analyze_head_position(pil_image, cv_image)
-    drowsiness_score = analyze_drowsiness(pil_image, cv_image)
-    contrast = analyze_image_contrast(pil_image)
+    contrast = analyze_image_contrast(frame)
     
-    # Enhanced sleeping detection
-    face_mesh_results = detect_face_mesh_mediapipe(cv_image)
-    is_sleeping = False
-    sleeping_score = 0.0
+    # Stage 2: lightweight face detector, FaceMesh only runs once a face is found. Turned heads the
+    # detector misses are still followed by a tracking mesh that held the face on the previous frame.
+    face_bbox, _ = frame.face_detection
     
-    if face_mesh_results.multi_face_landmarks:
-        face_landmarks = face_mesh_results.multi_face_landmarks[0]
-        is_sleeping, sleeping_score = detect_sleeping_state(face_landmarks, cv_image.shape, eye_openness)
+    if face_bbox is None and not frame.tracking_face:
+        if frame.debug:
+            logger.debug("User %s - brightness %.2f, detected ABSENT (no face detected)", user_id, brightness)
+        user_data.add_measurement(Measurement(brightness, contrast, 0, 0, 0.0))
+        user_data.add_state(ABSENT)
+        return ABSENT, STAGE_FACE_DETECTION
     
-    measurement = {
-        'brightness': brightness,
-        'contrast': contrast,
-        'face_presence': face_presence,
-        'eye_openness': eye_openness,
-        'looking_score': looking_score,
-        'drowsiness_score': drowsiness_score,
-        'sleeping_score': sleeping_score,
-        'timestamp': time.time()
-    }
+    # Stage 3: full landmark analysis
+    calibrate_from_frame(frame, user_id)
     
-    user_data[user_id]['measurements'].append(measurement)
+    face_presence = analyze_face_present(frame)
+    eye_openness = analyze_eye_area(frame)
+    looking_score = analyze_head_position(frame)
+    drowsiness_score = analyze_drowsiness(frame)
     
-    print(f"DEBUG - User {user_id} - Current snapshot values:")
-    print(f"  Face presence: {face_presence:.2f}")
-    print(f"  Eye openness: {eye_openness:.2f}")
-    print(f"  Looking score: {looking_score:.2f}")
-    print(f"  Drowsiness score: {drowsiness_score:.2f}")
-    print(f"  Sleeping score: {sleeping_score:.2f}")
-    print(f"  Contrast: {contrast:.2f}")
+    # Enhanced sleeping detection
+    is_sleeping, sleeping_score = detect_sleeping_state(frame, eye_openness)
     
-    # ENHANCED STATE DETECTION with improved thresholds
+    user_data.add_measurement(Measurement(
+        brightness, contrast, face_presence, eye_openness,
+        looking_score, drowsiness_score, sleeping_score
+    ))
     
-    # 1. DARKNESS: Very low brightness
-    if brightness < 15:
-        print(f"DEBUG - User {user_id} - Detected DARKNESS (brightness < 15)")
-        user_data[user_id]['state_history'].append(DARKNESS)
-        return DARKNESS
+    if frame.debug:
+        logger.debug(
+            "User %s - brightness %.2f, contrast %.2f, face presence %.2f, eye openness %.2f, "
+            "looking score %.2f, drowsiness score %.2f, sleeping score %.2f",
+            user_id, brightness, contrast, face_presence, eye_openness,
+            looking_score, drowsiness_score, sleeping_score
+        )
+    
+    # ENHANCED STATE DETECTION with improved thresholds
     
-    # 2. ABSENT: No face detected
+    # 1. ABSENT: No face detected
     if face_presence < 8:
-        print(f"DEBUG - User {user_id} - Detected ABSENT (face_presence < 8)")
-        user_data[user_id]['state_history'].append(ABSENT)
-        return ABSENT
+        if frame.debug:
+            logger.debug("User %s - detected ABSENT (face_presence < 8)", user_id)
+        user_data.add_state(ABSENT)
+        return ABSENT, STAGE_LANDMARKS
     
     # 2. SLEEPING: Eyes completely closed
     if eye_openness < 5 or sleeping_score > 0.7:
-        print(f"DEBUG - User {user_id} - Detected SLEEPING (eye_openness < 5 or sleeping_score > 0.7)")
-        user_data[user_id]['state_history'].append(SLEEPING)
-        return SLEEPING
+        if frame.debug:
+            logger.debug("User %s - detected SLEEPING (eye_openness < 5 or sleeping_score > 0.7)", user_id)
+        user_data.add_state(SLEEPING)
+        return SLEEPING, STAGE_LANDMARKS
     
     # 3. DROWSY: Eyes partially closed
     if eye_openness < 20 or drowsiness_score > 50:
-        print(f"DEBUG - User {user_id} - Detected DROWSY (eye_openness < 20 or drowsiness_score > 50)")
-        user_data[user_id]['state_history'].append(DROWSY)
-        return DROWSY
+        if frame.debug:
+            logger.debug("User %s - detected DROWSY (eye_openness < 20 or drowsiness_score > 50)", user_id)
+        user_data.add_state(DROWSY)
+        return DROWSY, STAGE_LANDMARKS
     
     # 4. LOOKING_AWAY: Head tilted or turned
     if looking_score < 0.6:
-        print(f"DEBUG - User {user_id} - Detected LOOKING_AWAY (looking_score < 0.6)")
-        user_data[user_id]['state_history'].append(LOOKING_AWAY)
-        return LOOKING_AWAY
+        if frame.debug:
+            logger.debug("User %s - detected LOOKING_AWAY (looking_score < 0.6)", user_id)
+        user_data.add_state(LOOKING_AWAY)
+        return LOOKING_AWAY, STAGE_LANDMARKS
     
     # Enhanced attentive detection - high standards for immediate response
     if (face_presence > 30 and eye_openness > 30 and looking_score > 0.8 and drowsiness_score < 30):
-        print(f"DEBUG - User {user_id} - Detected ATTENTIVE (all high conditions met)")
-        user_data[user_id]['state_history'].append(ATTENTIVE)
-        return ATTENTIVE
+        if frame.debug:
+            logger.debug("User %s - detected ATTENTIVE (all high conditions met)", user_id)
+        user_data.add_state(ATTENTIVE)
+        return ATTENTIVE, STAGE_LANDMARKS
     
     # Default to looking away if no clear state detected
-    print(f"DEBUG - User {user_id} - Detected LOOKING_AWAY (default case)")
-    user_data[user_id]['state_history'].append(LOOKING_AWAY)
-    return LOOKING_AWAY
+    if frame.debug:
+        logger.debug("User %s - detected LOOKING_AWAY (default case)", user_id)
+    user_data.add_state(LOOKING_AWAY)
+    return LOOKING_AWAY, STAGE_LANDMARKS
+
+def lookup_frame_cache(frame, user_data):
+    """Reuse the previous result if this frame is close enough to the last analyzed one"""
+    hit = (
+        user_data.cache_signature is not None
+        and FRAME_SKIP_THRESHOLD > 0
+        and time.time() - user_data.cache_time < FRAME_SKIP_MAX_AGE
+        and frame_signature_distance(frame.signature, user_data.cache_signature) <= FRAME_SKIP_THRESHOLD
+    )
+    
+    with frame_cache_stats_lock:
+        frame_cache_stats['hits' if hit else 'misses'] += 1
+    
+    if not hit:
+        return None
+    
+    # Replay the cached measurements so the per-user series keep advancing
+    if user_data.cache_measurement is not None:
+        measurement = user_data.cache_measurement
+        measurement.timestamp = time.time()
+        user_data.add_measurement(measurement)
+    user_data.add_state(user_data.cache_state)
+    
+    return user_data.cache_state
 
-def process_attention_request(pil_image, cv_image, user_id):
+def store_frame_cache(frame, user_data, attention_state):
+    """Remember the signature and measurements of a fully analyzed frame"""
+    user_data.cache_signature = frame.signature
+    user_data.cache_time = time.time()
+    user_data.cache_state = attention_state
+    # Only a row recorded for this frame may be replayed; an older one would describe another frame
+    measurement = user_data.latest_measurement()
+    if measurement is not None and measurement.timestamp < frame.started_at:
+        measurement = None
+    user_data.cache_measurement = measurement
+
+def get_frame_cache_stats():
+    """Hit/miss counters of the frame-difference skip cache"""
+    with frame_cache_stats_lock:
+        hits = frame_cache_stats['hits']
+        misses = frame_cache_stats['misses']
+    
+    total = hits + misses
+    return {
+        'hits': hits,
+        'misses': misses,
+        'hit_rate': round(hits / total, 3) if total else 0.0
+    }
+
+def get_state_percentage(attention_state):
+    """Immediate attention percentage for a state"""
+    if attention_state == ATTENTIVE:
+        return 95  # High attention
+    elif attention_state == LOOKING_AWAY:
+        return 40  # Low attention
+    elif attention_state == DROWSY:
+        return 25  # Very low attention
+    elif attention_state == SLEEPING:
+        return 5   # Minimal attention (sleeping)
+    elif attention_state == ABSENT:
+        return 0   # No attention
+    elif attention_state == DARKNESS:
+        return 0   # No attention (darkness)
+    return 0
+
+def get_state_category(attention_state):
+    """Room-level attention category for a state"""
+    if attention_state == SLEEPING:
+        return "sleeping"
+    elif attention_state in [LOOKING_AWAY, DROWSY]:
+        return "distracted"
+    elif attention_state in [ABSENT, DARKNESS]:
+        return "inactive"
+    return "attentive"
+
+def build_room_record(user_data, confidence):
+    """A member's entry in room attention responses"""
+    return {
+        'attentionState': user_data.current_state,
+        'attentionCategory': get_state_category(user_data.current_state),
+        'stateSince': user_data.state_since,
+        'attentionPercentage': get_state_percentage(user_data.current_state),
+        'confidence': round(confidence * 100, 1)
+    }
+
+def process_attention_request(cv_image, user_id, room_id=None, deadline=None):
     """Process attention detection request with thread safety"""
-    with processing_lock:
-        attention_state = detect_attention(pil_image, cv_image, user_id)
-        user_data = update_attention_history(user_id, attention_state)
+    frame = FrameAnalysis(cv_image, user_id=user_id)
+    
+    # Frames of one user are serialized; different users run in parallel on pooled detectors
+    with get_user_lock(user_id):
+        user_data = get_user_attention_data(user_id)
+        attention_state = lookup_frame_cache(frame, user_data)
         
-        # Calculate immediate attention percentage based on current state
-        attention_percentage = 0
+        if attention_state is not None:
+            decision_stage = STAGE_FRAME_CACHE
+        else:
+            with detector_pool.checkout() as detectors, tracker_sessions.checkout(user_id) as tracker:
+                # Waiting for a detector may have used up the request's budget
+                check_deadline(deadline)
+                frame.use_detectors(detectors, tracker)
+                attention_state, decision_stage = detect_attention(frame, user_data)
+            store_frame_cache(frame, user_data, attention_state)
         
-        if attention_state == ATTENTIVE:
-            attention_percentage = 95  # High attention
-        elif attention_state == LOOKING_AWAY:
-            attention_percentage = 40  # Low attention
-        elif attention_state == DROWSY:
-            attention_percentage = 25  # Very low attention
-        elif attention_state == SLEEPING:
-            attention_percentage = 5   # Minimal attention (sleeping)
-        elif attention_state == ABSENT:
-            attention_percentage = 0   # No attention
-        elif attention_state == DARKNESS:
-            attention_percentage = 0   # No attention (darkness)
+        # The cascade judges this frame alone; the temporal filters decide whether the user's state changed
+        attention_state = update_temporal_state(user_data, attention_state)
+        update_attention_history(user_data, attention_state)
+        set_user_room(user_data, room_id)
+        save_user_attention_data(user_data)
+        
+        # Calculate immediate attention percentage based on current state
+        attention_percentage = get_state_percentage(attention_state)
         
         current_timestamp = int(time.time() * 1000)
         
-        measurements = []
-        if 'measurements' in user_data:
-            measurements = list(user_data['measurements'])[-3:]
+        measurements = user_data.recent_measurements(3)
+        smoothed = smoothed_measurement(user_data)
         
         confidence = get_attention_state_confidence(
-            measurements, 
+            [smoothed] if smoothed is not None else [],
             attention_state, 
             user_id
         )
         
+        # Keep the room aggregate current; it only changes when the member's record does
+        if user_data.room_id is not None:
+            room_registry.record(user_data.room_id, user_id, build_room_record(user_data, confidence))
+        
         # Get current measurements for logging
-        current_measurements = {}
-        if 'measurements' in user_data and user_data['measurements']:
-            latest_measurement = user_data['measurements'][-1]
-            current_measurements = {
-                'brightness': latest_measurement.get('brightness', 0),
-                'contrast': latest_measurement.get('contrast', 0),
-                'facePresence': latest_measurement.get('face_presence', 0),
-                'eyeOpenness': latest_measurement.get('eye_openness', 0),
-                'lookingScore': latest_measurement.get('looking_score', 0),
-                'drowsinessScore': latest_measurement.get('drowsiness_score', 0),
-                'sleepingScore': latest_measurement.get('sleeping_score', 0)
-            }
+        current_measurements = measurements[-1].to_dict() if measurements else {}
+        perclos = get_perclos(user_data)
         
         return {
             'userId': user_id,
             'attentionState': attention_state,
-            'stateSince': user_data.get("state_since", current_timestamp),
+            'stateSince': user_data.state_since,
             'attentionPercentage': attention_percentage,
             'confidence': round(confidence * 100, 1),
             'timestamp': current_timestamp,
-            'measurements': current_measurements
+            'measurements': current_measurements,
+            'decisionStage': decision_stage,
+            'perclos': round(perclos, 3) if perclos is not None else None,
+            'nextFrameMs': recommend_frame_interval(user_data, confidence, current_timestamp)
         }
 
-def get_room_attention_data(room_id, user_ids):
-    """Get attention data for all users in a room"""
+def get_room_snapshot(room_id):
+    """Cached (json_bytes, etag) of a room's aggregate, or None when this process cannot serve it"""
+    if is_state_shared():
+        # Members may be served by other processes; their records come from the shared store instead
+        return None
+    return room_registry.snapshot(room_id)
+
+def get_room_attention_data(room_id, user_ids=None):
+    """Get attention data for the given users, or for the room's known members"""
     room_attention = {}
     current_timestamp = int(time.time() * 1000)
     
+    if user_ids is None:
+        user_ids = get_room_member_ids(room_id)
+    
+    # Members of the room aggregate are served from their precomputed records. With shared state a
+    # user's frames may have moved to another process, so the shared store is the only current source.
+    records = {} if is_state_shared() else room_registry.member_records(room_id, user_ids)
+    missing = [user_id for user_id in user_ids if user_id not in records]
+    
+    # Read-only: unknown ids are reported absent without creating state for them
+    users = find_users_attention_data(missing) if missing else {}
+    
     for user_id in user_ids:
-        user_data = get_user_attention_data(user_id)
+        record = records.get(user_id)
+        user_data = users.get(user_id)
         
-        if user_data and user_id in user_data:
-            # Calculate immediate attention percentage based on current state
-            current_state = user_data.get("current_state", ABSENT)
-            attention_percentage = 0
-            
-            if current_state == ATTENTIVE:
-                attention_percentage = 95  # High attention
-            elif current_state == LOOKING_AWAY:
-                attention_percentage = 40  # Low attention
-            elif current_state == DROWSY:
-                attention_percentage = 25  # Very low attention
-            elif current_state == SLEEPING:
-                attention_percentage = 5   # Minimal attention (sleeping)
-            elif current_state == ABSENT:
-                attention_percentage = 0   # No attention
-            elif current_state == DARKNESS:
-                attention_percentage = 0   # No attention (darkness)
-            
-            measurements = []
-            if 'measurements' in user_data:
-                measurements = list(user_data['measurements'])[-5:]
+        if record is not None:
+            room_attention[user_id] = record
+        elif user_data is not None and user_data.current_state is not None:
+            smoothed = smoothed_measurement(user_data)
             
             confidence = get_attention_state_confidence(
-                measurements, 
-                current_state, 
+                [smoothed] if smoothed is not None else [], 
+                user_data.current_state, 
                 user_id
             )
-
-            attention_category = "attentive"
-            if current_state == SLEEPING:
-                attention_category = "sleeping"
-            elif current_state in [LOOKING_AWAY, DROWSY]:
-                attention_category = "distracted"
-            elif current_state in [ABSENT, DARKNESS]:
-                attention_category = "inactive"
-                
-            room_attention[user_id] = {
-                'attentionState': current_state,
-                'attentionCategory': attention_category,
-                'stateSince': user_data.get("state_since", current_timestamp),
-                'attentionPercentage': attention_percentage,
-                'confidence': round(confidence * 100, 1)
-            }
+            room_attention[user_id] = build_room_record(user_data, confidence)
         else:
             room_attention[user_id] = {
                 'attentionState': ABSENT,
@@ -254,4 +340,4 @@ def get_room_attention_data(room_id, user_ids):
                 'confidence': 100
             }
     
-    return room_attention 
\ No newline at end of file
+    return room_attention, summarize_attention(room_attention)
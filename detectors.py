@@ -0,0 +1,386 @@
+import os
+import math
+import time
+import queue
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+import numpy as np
+
+def _cgroup_cpu_quota():
+    """CPU quota of this container in cores (cgroup v2, then v1), or None when unlimited"""
+    try:
+        with open('/sys/fs/cgroup/cpu.max') as f:
+            quota, period = f.read().split()[:2]
+        return None if quota == 'max' else int(quota) / int(period)
+    except (OSError, ValueError):
+        pass
+    try:
+        with open('/sys/fs/cgroup/cpu/cpu.cfs_quota_us') as f:
+            quota = int(f.read())
+        with open('/sys/fs/cgroup/cpu/cpu.cfs_period_us') as f:
+            period = int(f.read())
+        return None if quota <= 0 else quota / period
+    except (OSError, ValueError):
+        return None
+
+def available_cpus():
+    """Cores this process can really use: its affinity mask, capped by the container's CPU quota"""
+    try:
+        cpus = len(os.sched_getaffinity(0))
+    except AttributeError:
+        cpus = os.cpu_count() or 1
+    quota = _cgroup_cpu_quota()
+    if quota is not None:
+        cpus = min(cpus, math.ceil(quota))
+    return max(1, cpus)
+
+# Number of independent detector sets, i.e. frames that can be analyzed in parallel
+DETECTOR_POOL_SIZE = max(1, int(os.environ.get('DETECTOR_POOL_SIZE', available_cpus())))
+
+# Per-user FaceMesh tracking sessions (each graph costs roughly 12 MB)
+TRACKER_MAX_SESSIONS = max(0, int(os.environ.get('TRACKER_MAX_SESSIONS', 16)))
+TRACKER_IDLE_TIMEOUT = float(os.environ.get('TRACKER_IDLE_TIMEOUT', 30))
+
+# Side of the blank frame used to warm up graphs before the first request
+WARMUP_FRAME_SIZE = 256
+
+# Detector registry: factories by name, shared instances built on first use in each process.
+# MediaPipe itself is only imported by the factories, so importing this module stays cheap.
+detector_factories = {}
+shared_detectors = {}
+shared_detector_locks = {}
+registry_lock = threading.Lock()
+registry_pid = os.getpid()
+
+def register_detector(name, factory):
+    """Register a factory building a MediaPipe graph under a name"""
+    detector_factories[name] = factory
+
+def create_detector(name):
+    """Build a new, private instance of a registered detector"""
+    return detector_factories[name]()
+
+def _check_fork():
+    """Forget graphs inherited from a parent process; they are not fork-safe"""
+    global registry_pid
+    if registry_pid != os.getpid():
+        shared_detectors.clear()
+        shared_detector_locks.clear()
+        registry_pid = os.getpid()
+
+@contextmanager
+def shared_detector(name):
+    """Use the process-wide instance of a detector, building it on first use"""
+    with registry_lock:
+        _check_fork()
+        lock = shared_detector_locks.setdefault(name, threading.Lock())
+
+    # MediaPipe graphs are not thread-safe, so a shared instance serves one caller at a time
+    with lock:
+        detector = shared_detectors.get(name)
+        if detector is None:
+            detector = shared_detectors[name] = create_detector(name)
+        yield detector
+
+def _face_mesh_factory(static_image_mode):
+    def factory():
+        from mediapipe.python.solutions import face_mesh as mp_face_mesh
+        return mp_face_mesh.FaceMesh(
+            static_image_mode=static_image_mode,
+            max_num_faces=1,
+            min_detection_confidence=0.5,
+            min_tracking_confidence=0.5
+        )
+    return factory
+
+def _face_detection_factory():
+    from mediapipe.python.solutions import face_detection as mp_face_detection
+    return mp_face_detection.FaceDetection(
+        model_selection=1,
+        min_detection_confidence=0.5
+    )
+
+def _pose_factory():
+    from mediapipe.python.solutions import pose as mp_pose
+    return mp_pose.Pose(
+        static_image_mode=False,
+        model_complexity=1,
+        min_detection_confidence=0.5,
+        min_tracking_confidence=0.5
+    )
+
+register_detector('face_mesh_static', _face_mesh_factory(static_image_mode=True))
+register_detector('face_mesh_tracking', _face_mesh_factory(static_image_mode=False))
+register_detector('face_detection', _face_detection_factory)
+register_detector('pose', _pose_factory)
+
+class DetectorSet:
+    """One set of MediaPipe graphs, used by a single request at a time"""
+
+    def __init__(self):
+        self.face_detection = create_detector('face_detection')
+        self._face_mesh = None
+
+    @property
+    def face_mesh(self):
+        """Non-tracking FaceMesh, only built when no per-user tracking session is available"""
+        # Frames reaching the pooled mesh come from unrelated users, so it never tracks
+        if self._face_mesh is None:
+            self._face_mesh = create_detector('face_mesh_static')
+        return self._face_mesh
+
+    def close(self):
+        """Release the underlying MediaPipe graphs"""
+        if self._face_mesh is not None:
+            self._face_mesh.close()
+        self.face_detection.close()
+
+class DetectorPool:
+    """Bounded pool of detector sets; graphs are built on demand up to the pool size"""
+
+    def __init__(self, size):
+        self.size = size
+        self._available = queue.LifoQueue()
+        self._created = 0
+        self._lock = threading.Lock()
+
+    def _acquire(self):
+        try:
+            return self._available.get_nowait()
+        except queue.Empty:
+            pass
+
+        with self._lock:
+            if self._created < self.size:
+                self._created += 1
+                create = True
+            else:
+                create = False
+
+        if create:
+            try:
+                return DetectorSet()
+            except Exception:
+                with self._lock:
+                    self._created -= 1
+                raise
+
+        # Every detector set is busy, wait for one to be returned
+        return self._available.get()
+
+    @contextmanager
+    def checkout(self):
+        """Check out a detector set for the duration of one frame"""
+        detectors = self._acquire()
+        try:
+            yield detectors
+        finally:
+            self._available.put(detectors)
+
+    def preload(self, include_face_mesh=False):
+        """Build every detector set and run a blank frame through it"""
+        blank = np.zeros((WARMUP_FRAME_SIZE, WARMUP_FRAME_SIZE, 3), dtype=np.uint8)
+        detector_sets = [self._acquire() for _ in range(self.size)]
+        try:
+            for detectors in detector_sets:
+                detectors.face_detection.process(blank)
+                if include_face_mesh:
+                    detectors.face_mesh.process(blank)
+        finally:
+            for detectors in detector_sets:
+                self._available.put(detectors)
+
+    def stats(self):
+        """Pool usage for monitoring"""
+        idle = self._available.qsize()
+        return {
+            'size': self.size,
+            'created': self._created,
+            'in_use': self._created - idle
+        }
+
+class TrackerSession:
+    """FaceMesh graph in tracking mode fed with the frames of a single user"""
+
+    def __init__(self):
+        self.face_mesh = create_detector('face_mesh_tracking')
+        self.last_used = time.time()
+        self.in_use = 0
+        self.evicted = False
+        # Whether the previous frame left the graph tracking a face
+        self.has_face = False
+
+    def close(self):
+        """Release the underlying MediaPipe graph"""
+        self.face_mesh.close()
+
+class TrackerLease:
+    """A frame's claim on its user's tracking session, taken the first time FaceMesh is needed"""
+
+    def __init__(self, manager, key):
+        self.manager = manager
+        self.key = key
+        self.session = None
+        self.acquired = False
+
+    @property
+    def face_mesh(self):
+        """The tracking FaceMesh, or None when the caller should use the pooled one"""
+        if not self.acquired:
+            self.acquired = True
+            self.session = self.manager._acquire(self.key)
+        return self.session.face_mesh if self.session is not None else None
+
+    @property
+    def tracking_face(self):
+        """Whether the user's session followed a face through the previous frame"""
+        return self.manager.tracking_face(self.key)
+
+    def record_result(self, has_face):
+        """Remember whether FaceMesh found a face in this frame"""
+        if self.session is not None:
+            self.session.has_face = has_face
+
+    def release(self):
+        if self.session is not None:
+            self.manager._release(self.session)
+            self.session = None
+
+class TrackerSessionManager:
+    """LRU of per-user tracking sessions with an idle timeout"""
+
+    def __init__(self, max_sessions, idle_timeout):
+        self.max_sessions = max_sessions
+        self.idle_timeout = idle_timeout
+        self._sessions = OrderedDict()
+        self._lock = threading.Lock()
+        self.created = 0
+        self.evicted = 0
+        self.fallbacks = 0
+
+    def _evict(self, key):
+        """Detach a session; it is closed now or when its last user releases it"""
+        session = self._sessions.pop(key)
+        session.evicted = True
+        self.evicted += 1
+        return session if session.in_use == 0 else None
+
+    def _expire(self, now):
+        """Evict idle sessions; the OrderedDict is kept in last-used order"""
+        to_close = []
+        while self._sessions:
+            key, session = next(iter(self._sessions.items()))
+            if now - session.last_used < self.idle_timeout:
+                break
+            to_close.append(self._evict(key))
+        return to_close
+
+    def _acquire(self, key):
+        """The user's session, a new one if there is room, or None when the LRU is full or disabled"""
+        if self.max_sessions == 0:
+            return None
+
+        with self._lock:
+            to_close = self._expire(time.time())
+            session = self._sessions.get(key)
+            if session is not None:
+                self._sessions.move_to_end(key)
+                session.in_use += 1
+            full = session is None and len(self._sessions) >= self.max_sessions
+            if full:
+                self.fallbacks += 1
+        self._close_all(to_close)
+        if session is not None or full:
+            # Live sessions are never evicted to make room; overflow users share the pooled static mesh
+            return session
+
+        # Built outside the lock; callers already serialize the frames of one user
+        session = TrackerSession()
+        session.in_use = 1
+        with self._lock:
+            to_close = []
+            if key in self._sessions:
+                to_close.append(self._evict(key))
+            if len(self._sessions) >= self.max_sessions:
+                # Filled up while the graph was being built
+                self.fallbacks += 1
+                to_close.append(session)
+                session = None
+            else:
+                self._sessions[key] = session
+                self.created += 1
+        self._close_all(to_close)
+        return session
+
+    def _release(self, session):
+        with self._lock:
+            session.in_use -= 1
+            session.last_used = time.time()
+            close_now = session.evicted and session.in_use == 0
+        if close_now:
+            session.close()
+
+    def _close_all(self, sessions):
+        for stale in sessions:
+            if stale:
+                stale.close()
+
+    @contextmanager
+    def checkout(self, key):
+        """Yield a lease on the user's tracking FaceMesh, acquired only if the frame gets to FaceMesh"""
+        lease = TrackerLease(self, key)
+        try:
+            yield lease
+        finally:
+            lease.release()
+
+    def tracking_face(self, key):
+        with self._lock:
+            session = self._sessions.get(key)
+            return session is not None and session.has_face
+
+    def expire_idle(self):
+        """Close sessions idle for longer than the timeout"""
+        with self._lock:
+            to_close = self._expire(time.time())
+        self._close_all(to_close)
+
+    def close(self, key):
+        """Drop the session of a user whose state was removed"""
+        with self._lock:
+            if key not in self._sessions:
+                return
+            session = self._evict(key)
+        if session:
+            session.close()
+
+    def stats(self):
+        """Session usage for monitoring"""
+        return {
+            'active': len(self._sessions),
+            'max': self.max_sessions,
+            'created': self.created,
+            'evicted': self.evicted,
+            'fallbacks': self.fallbacks
+        }
+
+detector_pool = DetectorPool(DETECTOR_POOL_SIZE)
+tracker_sessions = TrackerSessionManager(TRACKER_MAX_SESSIONS, TRACKER_IDLE_TIMEOUT)
+
+def warmup():
+    """Build this process's graphs and run a warmup inference so the first request skips initialization"""
+    started = time.time()
+    # The pooled FaceMesh serves every frame when per-user tracking sessions are disabled,
+    # otherwise only users beyond TRACKER_MAX_SESSIONS, and is then built on first use
+    detector_pool.preload(include_face_mesh=tracker_sessions.max_sessions == 0)
+
+    # Tracking sessions are per user, but building one now initializes the shared
+    # FaceMesh model resources before real traffic arrives
+    with tracker_sessions.checkout('__warmup__') as tracker:
+        face_mesh = tracker.face_mesh
+        if face_mesh is not None:
+            face_mesh.process(np.zeros((WARMUP_FRAME_SIZE, WARMUP_FRAME_SIZE, 3), dtype=np.uint8))
+    tracker_sessions.close('__warmup__')
+
+    return time.time() - started
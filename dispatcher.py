@@ -0,0 +1,551 @@
+"""Consistent-hash front dispatcher: python dispatcher.py
+
+Runs DISPATCH_WORKERS single-process gunicorn workers, each listening on its own
+Unix socket, and forwards every request to the worker that owns its userId (or
+roomId with DISPATCH_KEY=roomId) on a hash ring. A user's frames therefore keep
+hitting the same process, so tracking sessions, calibration and in-memory state
+stay local without a shared store. Batch and room requests are split by owner
+and merged. Workers that exit are dropped from the ring, restarted, and added
+back once healthy; only the keys of that worker move in the meantime.
+"""
+import os
+import sys
+import json
+import time
+import signal
+import socket
+import bisect
+import hashlib
+import logging
+import threading
+import subprocess
+import http.client
+from email.parser import BytesParser
+from email.policy import HTTP
+from urllib.parse import urlsplit, parse_qs
+from concurrent.futures import ThreadPoolExecutor
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from app_logging import configure_logging
+from rooms import summarize_attention, parse_user_ids
+from detectors import available_cpus
+
+logger = logging.getLogger('dispatcher')
+
+PORT = int(os.environ.get('PORT', 5000))
+DISPATCH_WORKERS = max(1, int(os.environ.get('DISPATCH_WORKERS', max(1, available_cpus() // 2))))
+DISPATCH_KEY = os.environ.get('DISPATCH_KEY', 'userId')
+DISPATCH_VNODES = int(os.environ.get('DISPATCH_VNODES', 64))
+DISPATCH_SOCKET_DIR = os.environ.get('DISPATCH_SOCKET_DIR', '/tmp')
+DISPATCH_TIMEOUT = float(os.environ.get('DISPATCH_TIMEOUT', 120))
+
+# Pooled worker connections idle longer than this (seconds) are reopened before use; keep it
+# below the workers' keepalive so a request is never written to a socket the worker is closing
+DISPATCH_IDLE_RECONNECT = float(os.environ.get('DISPATCH_IDLE_RECONNECT', 4))
+
+# Delay before restarting a worker that exited, doubled while it keeps failing
+RESTART_BACKOFF = 1.0
+RESTART_BACKOFF_MAX = 30.0
+
+# Request headers carrying routing keys for binary frame uploads
+KEY_HEADERS = {'userId': 'X-User-Id', 'roomId': 'X-Room-Id'}
+ROUTING_FIELDS = ('userId', 'roomId')
+
+NO_WORKERS_ERROR = 'No workers available'
+
+HOP_BY_HOP_HEADERS = {
+    'connection', 'keep-alive', 'proxy-authenticate', 'proxy-authorization',
+    'te', 'trailers', 'transfer-encoding', 'upgrade'
+}
+
+class HashRing:
+    """Consistent hash ring with virtual nodes"""
+
+    def __init__(self, vnodes=DISPATCH_VNODES):
+        self.vnodes = vnodes
+        self._points = []
+        self._owners = []
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _hash(value):
+        return int.from_bytes(hashlib.md5(value.encode()).digest()[:8], 'big')
+
+    def add(self, node):
+        with self._lock:
+            for replica in range(self.vnodes):
+                point = self._hash(f'{node}#{replica}')
+                index = bisect.bisect(self._points, point)
+                self._points.insert(index, point)
+                self._owners.insert(index, node)
+
+    def remove(self, node):
+        with self._lock:
+            kept = [(point, owner) for point, owner in zip(self._points, self._owners) if owner != node]
+            self._points = [point for point, _ in kept]
+            self._owners = [owner for _, owner in kept]
+
+    def lookup(self, key):
+        """Node owning key, or None when the ring is empty"""
+        with self._lock:
+            if not self._points:
+                return None
+            index = bisect.bisect(self._points, self._hash(str(key))) % len(self._points)
+            return self._owners[index]
+
+    def nodes(self):
+        with self._lock:
+            return sorted(set(self._owners))
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+    """HTTP connection over a Unix domain socket"""
+
+    def __init__(self, path, timeout=DISPATCH_TIMEOUT):
+        super().__init__('localhost', timeout=timeout)
+        self.path = path
+        self.last_used = time.monotonic()
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.path)
+
+class Worker:
+    """One gunicorn process serving the app on a Unix socket"""
+
+    def __init__(self, index, pool_size):
+        self.index = index
+        self.pool_size = pool_size
+        self.socket_path = os.path.join(DISPATCH_SOCKET_DIR, f'attention-worker-{index}.sock')
+        self.process = None
+        self.started_at = 0
+        self.restarts = 0
+        # Connections are reused per dispatcher thread
+        self._connections = threading.local()
+
+    def start(self):
+        if os.path.exists(self.socket_path):
+            os.remove(self.socket_path)
+        env = dict(os.environ, DETECTOR_POOL_SIZE=str(self.pool_size))
+        self.process = subprocess.Popen([
+            sys.executable, '-m', 'gunicorn', '-c', 'gunicorn.conf.py',
+            '--bind', f'unix:{self.socket_path}', '--workers', '1', 'wsgi:app'
+        ], env=env, cwd=os.path.dirname(os.path.abspath(__file__)))
+        self.started_at = time.time()
+
+    def alive(self):
+        return self.process is not None and self.process.poll() is None
+
+    def connection(self):
+        conn = getattr(self._connections, 'conn', None)
+        if conn is not None and time.monotonic() - conn.last_used > DISPATCH_IDLE_RECONNECT:
+            self.discard(conn)
+            conn = None
+        if conn is None:
+            conn = self._connections.conn = UnixHTTPConnection(self.socket_path)
+        return conn
+
+    def discard(self, conn):
+        conn.close()
+        self._connections.conn = None
+
+    def request(self, method, path, body=None, headers=None):
+        """Send a request; only a reused connection that failed while sending is retried"""
+        for attempt in range(2):
+            conn = self.connection()
+            reused = conn.sock is not None
+            try:
+                conn.request(method, path, body=body, headers=headers or {})
+            except (ConnectionError, http.client.HTTPException, OSError) as e:
+                self.discard(conn)
+                # The worker never got the whole request, so sending it again cannot repeat any work
+                if attempt or not reused or isinstance(e, TimeoutError):
+                    raise
+                continue
+            try:
+                response = conn.getresponse()
+            except (ConnectionError, http.client.HTTPException, OSError):
+                # The request may already be running; a retry could analyze the frame twice
+                self.discard(conn)
+                raise
+            conn.last_used = time.monotonic()
+            return response
+
+    def request_json(self, method, path, payload):
+        response = self.request(method, path, json.dumps(payload).encode(), {'Content-Type': 'application/json'})
+        return response.status, json.loads(response.read() or b'null')
+
+    def ready(self):
+        try:
+            response = self.request('GET', '/api/test')
+            response.read()
+            return response.status == 200
+        except OSError:
+            return False
+
+class Dispatcher:
+    """Owns the workers and the hash ring mapping routing keys to them"""
+
+    def __init__(self, worker_count=DISPATCH_WORKERS):
+        pool_size = max(1, available_cpus() // worker_count)
+        self.workers = {index: Worker(index, pool_size) for index in range(worker_count)}
+        self.ring = HashRing()
+        self.fanout = ThreadPoolExecutor(max_workers=worker_count * 4, thread_name_prefix='dispatch-fanout')
+        self._round_robin = 0
+
+    def start(self):
+        for worker in self.workers.values():
+            worker.start()
+        threading.Thread(target=self._supervise, name='dispatch-supervisor', daemon=True).start()
+
+    def _wait_ready(self, worker, timeout=120):
+        deadline = time.time() + timeout
+        while time.time() < deadline and worker.alive():
+            if os.path.exists(worker.socket_path) and worker.ready():
+                return True
+            time.sleep(0.5)
+        return False
+
+    def _supervise(self):
+        """Add workers to the ring once healthy; drop, restart and re-add them when they exit"""
+        backoff = {index: RESTART_BACKOFF for index in self.workers}
+        pending = set(self.workers)
+        while True:
+            for index in list(pending):
+                worker = self.workers[index]
+                if self._wait_ready(worker):
+                    self.ring.add(index)
+                    pending.discard(index)
+                    backoff[index] = RESTART_BACKOFF
+                    logger.info("Worker %d (pid %d) joined the ring", index, worker.process.pid)
+
+            for index, worker in self.workers.items():
+                if worker.alive():
+                    continue
+                self.ring.remove(index)
+                logger.warning("Worker %d exited with %s, restarting in %.0fs",
+                               index, worker.process.returncode, backoff[index])
+                time.sleep(backoff[index])
+                backoff[index] = min(backoff[index] * 2, RESTART_BACKOFF_MAX)
+                worker.restarts += 1
+                worker.start()
+                pending.add(index)
+
+            time.sleep(0.5)
+
+    def owner(self, key):
+        """Worker owning a routing key; keyless requests are spread round-robin"""
+        if key is not None:
+            index = self.ring.lookup(key)
+        else:
+            nodes = self.ring.nodes()
+            self._round_robin += 1
+            index = nodes[self._round_robin % len(nodes)] if nodes else None
+        return self.workers[index] if index is not None else None
+
+    def routing_key(self, fields):
+        """The configured key from request fields, falling back to userId"""
+        return fields.get(DISPATCH_KEY) or fields.get('userId')
+
+    def split_batch(self, data):
+        """Forward batch items to their owners in parallel and merge results in request order"""
+        shared = {key: value for key, value in data.items() if key != 'items'}
+        groups = {}
+        for position, item in enumerate(data['items']):
+            fields = {**shared, **item} if isinstance(item, dict) else shared
+            worker = self.owner(self.routing_key(fields))
+            groups.setdefault(worker, []).append((position, item))
+
+        def forward(worker, entries):
+            if worker is None:
+                return [{'status': 503, 'error': NO_WORKERS_ERROR} for _ in entries]
+            status, body = worker.request_json('POST', '/api/detect_attention/batch', {
+                **shared, 'items': [item for _, item in entries]
+            })
+            if status != 200:
+                error = body.get('error', 'Worker error') if isinstance(body, dict) else 'Worker error'
+                return [{'status': status, 'error': error} for _ in entries]
+            return body['results']
+
+        results = [None] * len(data['items'])
+        futures = {self.fanout.submit(forward, worker, entries): entries for worker, entries in groups.items()}
+        for future, entries in futures.items():
+            try:
+                worker_results = future.result()
+            except OSError as e:
+                worker_results = [{'status': 503, 'error': str(e)} for _ in entries]
+            for (position, item), result in zip(entries, worker_results):
+                if isinstance(item, dict):
+                    result.setdefault('userId', item.get('userId'))
+                results[position] = result
+
+        failed = sum(1 for result in results if result.get('status') != 200)
+        return {
+            'results': results,
+            'succeeded': len(results) - failed,
+            'failed': failed,
+            'timestamp': int(time.time() * 1000)
+        }
+
+    def split_room(self, data):
+        """Query the owners of the room's users (every worker without userIds) and merge the results"""
+        user_ids = data.get('userIds')
+        if user_ids is None:
+            groups = {self.workers[index]: None for index in self.ring.nodes()}
+        else:
+            groups = {}
+            for user_id in user_ids:
+                groups.setdefault(self.owner(user_id), []).append(user_id)
+        if (not groups and user_ids is None) or None in groups:
+            return 503, {'error': NO_WORKERS_ERROR}
+
+        futures = [
+            self.fanout.submit(worker.request_json, 'POST', '/api/room_attention',
+                               data if worker_user_ids is None else {**data, 'userIds': worker_user_ids})
+            for worker, worker_user_ids in groups.items()
+        ]
+        merged = {}
+        timestamp = 0
+        for future in futures:
+            status, body = future.result()
+            if status != 200:
+                return status, body
+            merged.update(body['attention'])
+            if body['attention']:
+                # Workers without members answer with the current time, which would change every merge
+                timestamp = max(timestamp, body.get('timestamp', 0))
+
+        if user_ids is not None:
+            merged = {user_id: merged[user_id] for user_id in user_ids if user_id in merged}
+        # The newest worker timestamp rather than now, so an unchanged room merges to the same body
+        return 200, {
+            'roomId': data['roomId'],
+            'attention': merged,
+            'timestamp': timestamp or int(time.time() * 1000),
+            'summary': summarize_attention(merged)
+        }
+
+    def health(self):
+        workers = []
+        in_ring = set(self.ring.nodes())
+        for index, worker in self.workers.items():
+            workers.append({
+                'index': index,
+                'pid': worker.process.pid if worker.process else None,
+                'alive': worker.alive(),
+                'in_ring': index in in_ring,
+                'restarts': worker.restarts,
+                'uptime': round(time.time() - worker.started_at, 1)
+            })
+        return {
+            'status': 'ok' if in_ring else 'starting',
+            'timestamp': int(time.time() * 1000),
+            'dispatch_key': DISPATCH_KEY,
+            'workers': workers
+        }
+
+def etag_matches(if_none_match, etag):
+    """Whether an If-None-Match header names this (strong or weak) ETag"""
+    if not if_none_match:
+        return False
+    for candidate in if_none_match.split(','):
+        candidate = candidate.strip()
+        if candidate == '*' or candidate.removeprefix('W/').strip('"') == etag:
+            return True
+    return False
+
+dispatcher = None
+
+class DispatchHandler(BaseHTTPRequestHandler):
+    """Forwards each request to the worker owning its routing key"""
+
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        logger.debug("%s - %s", self.address_string(), format % args)
+
+    def _read_body(self):
+        if 'chunked' in self.headers.get('Transfer-Encoding', '').lower():
+            return self._read_chunked()
+        length = int(self.headers.get('Content-Length') or 0)
+        return self.rfile.read(length) if length else b''
+
+    def _read_chunked(self):
+        """Decode a chunked request body; it is forwarded to the worker with a Content-Length"""
+        chunks = []
+        while True:
+            size = int(self.rfile.readline().split(b';', 1)[0].strip() or b'0', 16)
+            if not size:
+                break
+            chunks.append(self.rfile.read(size))
+            self.rfile.readline()
+        # Trailer fields, if any, end with an empty line
+        while self.rfile.readline().strip():
+            pass
+        return b''.join(chunks)
+
+    def _send_json(self, status, payload):
+        body = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('Access-Control-Allow-Origin', '*')
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_room(self, status, payload):
+        """A merged whole-room response, with an ETag computed over the merged body"""
+        if status != 200:
+            return self._send_json(status, payload)
+        body = json.dumps(payload, sort_keys=True, separators=(',', ':')).encode()
+        etag = hashlib.md5(body).hexdigest()[:16]
+        if etag_matches(self.headers.get('If-None-Match'), etag):
+            self.send_response(304)
+            self.send_header('ETag', f'"{etag}"')
+            self.send_header('Content-Length', '0')
+            self.send_header('Access-Control-Allow-Origin', '*')
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('ETag', f'"{etag}"')
+        self.send_header('Access-Control-Allow-Origin', '*')
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _form_fields(self, body):
+        """userId/roomId text parts of a multipart upload"""
+        content_type = self.headers.get('Content-Type', '')
+        head = b'Content-Type: ' + content_type.encode('latin-1') + b'\r\n\r\n'
+        message = BytesParser(policy=HTTP).parsebytes(head + body)
+        fields = {}
+        if not message.is_multipart():
+            return fields
+        for part in message.iter_parts():
+            name = part.get_param('name', header='content-disposition')
+            if name in ROUTING_FIELDS and part.get_filename() is None:
+                fields[name] = part.get_payload(decode=True).decode(errors='replace').strip()
+        return fields
+
+    def _request_fields(self, body):
+        """Routing fields from JSON or form body, query string and metadata headers"""
+        fields = {key: values[0] for key, values in parse_qs(urlsplit(self.path).query).items()}
+        for field, header in KEY_HEADERS.items():
+            if header in self.headers:
+                fields.setdefault(field, self.headers[header])
+        if not body:
+            return fields, None
+        content_type = self.headers.get_content_type()
+        if content_type == 'application/json':
+            try:
+                data = json.loads(body)
+            except ValueError:
+                data = None
+            if isinstance(data, dict):
+                fields.update({key: data[key] for key in ROUTING_FIELDS if key in data})
+                return fields, data
+        elif content_type == 'multipart/form-data':
+            fields.update(self._form_fields(body))
+        elif content_type == 'application/x-www-form-urlencoded':
+            form = parse_qs(body.decode('latin-1'))
+            fields.update({key: form[key][0] for key in ROUTING_FIELDS if key in form})
+        return fields, None
+
+    def _proxy(self, worker, body):
+        headers = {key: value for key, value in self.headers.items() if key.lower() not in HOP_BY_HOP_HEADERS}
+        headers['Content-Length'] = str(len(body))
+        response = worker.request(self.command, self.path, body, headers)
+
+        self.send_response(response.status)
+        # send_response already wrote this server's Server and Date headers
+        for key, value in response.getheaders():
+            if key.lower() not in HOP_BY_HOP_HEADERS and key.lower() not in ('content-length', 'server', 'date'):
+                self.send_header(key, value)
+
+        length = response.getheader('Content-Length')
+        if self.command == 'HEAD' or response.status in (204, 304) or response.status < 200:
+            # These responses never carry a body; a HEAD answer keeps the length a GET would have
+            response.read()
+            if self.command == 'HEAD' and length is not None:
+                self.send_header('Content-Length', length)
+            self.end_headers()
+            return
+        if length is not None:
+            payload = response.read()
+            self.send_header('Content-Length', str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+            return
+
+        # Streamed responses are relayed chunk by chunk as they arrive
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+        while True:
+            chunk = response.read1(65536)
+            if not chunk:
+                break
+            self.wfile.write(b'%x\r\n%s\r\n' % (len(chunk), chunk))
+            self.wfile.flush()
+        self.wfile.write(b'0\r\n\r\n')
+
+    def _handle(self):
+        try:
+            body = self._read_body()
+        except ValueError:
+            # The rest of the stream cannot be framed, so the connection ends here
+            self.close_connection = True
+            return self._send_json(400, {'error': 'Malformed request body'})
+        path = urlsplit(self.path).path
+
+        if path == '/api/health' and self.command == 'GET':
+            return self._send_json(200, dispatcher.health())
+
+        fields, data = self._request_fields(body)
+        try:
+            if path == '/api/detect_attention/batch' and isinstance(data, dict) and isinstance(data.get('items'), list):
+                return self._send_json(200, dispatcher.split_batch(data))
+
+            if path == '/api/room_attention' and DISPATCH_KEY == 'userId':
+                if self.command == 'GET' and 'roomId' in fields:
+                    query = parse_qs(urlsplit(self.path).query, keep_blank_values=True)
+                    if 'userIds' in query:
+                        user_ids = parse_user_ids(query['userIds'])
+                        return self._send_json(*dispatcher.split_room({'roomId': fields['roomId'], 'userIds': user_ids}))
+                    # A room's members are spread over every worker; its snapshot has to be merged here
+                    return self._send_room(*dispatcher.split_room({'roomId': fields['roomId']}))
+                if (isinstance(data, dict) and 'roomId' in data
+                        and isinstance(data.get('userIds', []), list)):
+                    if data.get('userIds') is None:
+                        return self._send_room(*dispatcher.split_room(data))
+                    return self._send_json(*dispatcher.split_room(data))
+
+            worker = dispatcher.owner(dispatcher.routing_key(fields))
+            if worker is None:
+                return self._send_json(503, {'error': NO_WORKERS_ERROR})
+            self._proxy(worker, body)
+        except OSError as e:
+            logger.warning("Forwarding %s %s failed: %s", self.command, path, e)
+            self._send_json(503, {'error': 'Worker unavailable'})
+
+    do_GET = do_HEAD = do_POST = do_PUT = do_DELETE = do_OPTIONS = _handle
+
+def main():
+    global dispatcher
+    configure_logging()
+    # Turn SIGTERM into a normal exit so the workers are terminated with the dispatcher
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    dispatcher = Dispatcher()
+    dispatcher.start()
+
+    server = ThreadingHTTPServer(('0.0.0.0', PORT), DispatchHandler)
+    server.daemon_threads = True
+    logger.info("Dispatcher listening on port %d with %d workers keyed by %s", PORT, len(dispatcher.workers), DISPATCH_KEY)
+    try:
+        server.serve_forever()
+    finally:
+        for worker in dispatcher.workers.values():
+            if worker.alive():
+                worker.process.terminate()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,55 @@
+"""Gunicorn configuration for the attention server
+
+Each worker process builds its own MediaPipe graphs after fork (graphs are
+not fork-safe, so the app is not preloaded in the master), then runs a
+warmup inference before accepting requests. Worker, thread and detector
+pool sizes are derived from the cores available to the container (affinity
+and cgroup CPU quota, not the host's core count) and can be overridden with
+WEB_CONCURRENCY, GUNICORN_THREADS and DETECTOR_POOL_SIZE. Memory is not
+considered: on small instances set WEB_CONCURRENCY and TRACKER_MAX_SESSIONS
+explicitly (see render.yaml).
+"""
+import os
+from detectors import available_cpus
+
+cores = available_cpus()
+
+bind = f"0.0.0.0:{os.environ.get('PORT', 5000)}"
+
+# A couple of cores per worker: inference inside a worker already runs in parallel on its detector pool
+workers = int(os.environ.get('WEB_CONCURRENCY', max(1, cores // 2)))
+
+# Split the cores between workers so the pools together match the machine
+os.environ.setdefault('DETECTOR_POOL_SIZE', str(max(1, cores // workers)))
+detector_pool_size = int(os.environ['DETECTOR_POOL_SIZE'])
+
+# Extra threads beyond the pool keep health checks and room polls responsive while inference runs;
+# room streams and WebSockets hold a thread each while open, so they get GUNICORN_STREAM_THREADS more
+worker_class = 'gthread'
+stream_threads = int(os.environ.get('GUNICORN_STREAM_THREADS', 8))
+threads = int(os.environ.get('GUNICORN_THREADS', detector_pool_size * 2 + 2 + stream_threads))
+
+# Workers size their stream and WebSocket limit from the threads they actually have
+os.environ['GUNICORN_THREADS'] = str(threads)
+
+preload_app = False
+timeout = int(os.environ.get('GUNICORN_TIMEOUT', 120))
+graceful_timeout = 30
+keepalive = 5
+
+accesslog = '-'
+errorlog = '-'
+loglevel = os.environ.get('GUNICORN_LOG_LEVEL', 'info')
+
+def post_worker_init(worker):
+    """Build this worker's MediaPipe graphs once and warm them up before serving"""
+    from detectors import warmup
+    from utils import freeze_gc, start_janitor
+
+    elapsed = warmup()
+    freeze_gc()
+    start_janitor()
+    worker.log.info(
+        "Worker %s warmed up %s detector set(s) in %.2fs",
+        worker.pid, detector_pool_size, elapsed
+    )
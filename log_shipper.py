@@ -0,0 +1,250 @@
+import os
+import time
+import queue
+import atexit
+import logging
+import threading
+import requests
+from requests.adapters import HTTPAdapter
+from log_spool import LogSpool
+
+logger = logging.getLogger(__name__)
+
+NODE_SERVER_URL = os.environ.get('NODE_SERVER_URL', 'http://localhost:3001')
+
+# Records waiting to be shipped; beyond this new records are dropped and counted
+LOG_SHIPPER_QUEUE_SIZE = int(os.environ.get('LOG_SHIPPER_QUEUE_SIZE', 5000))
+LOG_SHIPPER_WORKERS = max(1, int(os.environ.get('LOG_SHIPPER_WORKERS', 2)))
+
+# A batch is sent when it reaches LOG_BATCH_SIZE records or LOG_FLUSH_INTERVAL seconds
+LOG_BATCH_SIZE = max(1, int(os.environ.get('LOG_BATCH_SIZE', 100)))
+LOG_FLUSH_INTERVAL = float(os.environ.get('LOG_FLUSH_INTERVAL', 1.0))
+
+# Retries per batch, with exponential backoff between attempts
+LOG_MAX_RETRIES = int(os.environ.get('LOG_MAX_RETRIES', 3))
+LOG_RETRY_BACKOFF = float(os.environ.get('LOG_RETRY_BACKOFF', 0.5))
+LOG_REQUEST_TIMEOUT = float(os.environ.get('LOG_REQUEST_TIMEOUT', 5))
+
+# Batches that cannot be delivered go to a disk spool and are replayed in order later
+LOG_SPOOL_ENABLED = os.environ.get('LOG_SPOOL_ENABLED', '1') == '1'
+LOG_SPOOL_REPLAY_MAX_BACKOFF = float(os.environ.get('LOG_SPOOL_REPLAY_MAX_BACKOFF', 30))
+
+class LogShipper:
+    """Ships attention logs to the Node.js server in batches from background workers"""
+
+    def __init__(self, base_url, queue_size=LOG_SHIPPER_QUEUE_SIZE, workers=LOG_SHIPPER_WORKERS,
+                 batch_size=LOG_BATCH_SIZE, flush_interval=LOG_FLUSH_INTERVAL, spool_enabled=LOG_SPOOL_ENABLED):
+        self.single_url = f"{base_url}/api/logs/attention"
+        self.bulk_url = f"{base_url}/api/logs/attention/bulk"
+        self.queue_size = queue_size
+        self.workers = workers
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.spool_enabled = spool_enabled
+        # Cleared when the server answers 404 on the bulk endpoint
+        self.bulk_supported = True
+        self.counters = {
+            'enqueued': 0,
+            'sent': 0,
+            'dropped_overflow': 0,
+            'dropped_failed': 0,
+            'retries': 0,
+            'batches': 0
+        }
+        self._counters_lock = threading.Lock()
+        self._start_lock = threading.Lock()
+        self._pid = None
+        self._queue = None
+        self._threads = []
+        self._session = None
+        self.spool = None
+
+    def _count(self, name, amount=1):
+        with self._counters_lock:
+            self.counters[name] += amount
+
+    def _ensure_started(self):
+        """Start the workers in this process; threads do not survive a fork"""
+        if self._pid == os.getpid():
+            return
+        with self._start_lock:
+            if self._pid == os.getpid():
+                return
+            self._queue = queue.Queue(maxsize=self.queue_size)
+            self._session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.workers)
+            self._session.mount('http://', adapter)
+            self._session.mount('https://', adapter)
+            self._threads = [
+                threading.Thread(target=self._run, name=f'log-shipper-{index}', daemon=True)
+                for index in range(self.workers)
+            ]
+            if self.spool_enabled:
+                try:
+                    self.spool = LogSpool.claim()
+                    self._threads.append(threading.Thread(target=self._replay, name='log-spool-replay', daemon=True))
+                except OSError as e:
+                    logger.warning("Log spool unavailable, undeliverable logs will be dropped: %s", e)
+                    self.spool = None
+            self._stopping = threading.Event()
+            for thread in self._threads:
+                thread.start()
+            self._pid = os.getpid()
+            atexit.register(self.close)
+
+    def submit(self, record):
+        """Queue a record for shipping; never blocks the caller"""
+        self._ensure_started()
+        try:
+            self._queue.put_nowait(record)
+        except queue.Full:
+            self._count('dropped_overflow')
+            return False
+        self._count('enqueued')
+        return True
+
+    def _next_batch(self):
+        """Block for a first record, then gather more until the batch is full or the interval ends"""
+        record = self._queue.get()
+        if record is None:
+            # Pass the stop marker on so close() reaches every worker
+            self._queue.put(None)
+            return None
+        batch = [record]
+        deadline = time.monotonic() + self.flush_interval
+        while len(batch) < self.batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                record = self._queue.get(timeout=remaining)
+            except queue.Empty:
+                break
+            if record is None:
+                # Pass the stop marker on so close() reaches every worker
+                self._queue.put(None)
+                break
+            batch.append(record)
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            if batch is None:
+                return
+            # While older records wait on disk, new ones queue behind them to keep delivery in order
+            if self.spool is not None and self.spool.pending():
+                self._spill(batch)
+            elif not self._ship(batch):
+                self._spill(batch)
+
+    def _spill(self, batch):
+        """Move an undeliverable batch to the disk spool, or drop it when there is none"""
+        if self.spool is not None:
+            try:
+                self.spool.append(batch)
+                return
+            except OSError as e:
+                logger.error("Could not write %d attention logs to spool: %s", len(batch), e)
+        self._count('dropped_failed', len(batch))
+
+    def _replay(self):
+        """Deliver spooled records oldest first, backing off while the server is unreachable"""
+        backoff = self.flush_interval
+        while not self._stopping.is_set():
+            try:
+                backoff = self._replay_once(backoff)
+            except Exception:
+                # A disk error must not end replay for good; try again after a pause
+                logger.exception("Log spool replay failed")
+                self._stopping.wait(backoff)
+                backoff = min(backoff * 2, LOG_SPOOL_REPLAY_MAX_BACKOFF)
+
+    def _replay_once(self, backoff):
+        """Deliver one batch from the spool; returns the backoff for the next attempt"""
+        self.spool.sync()
+        records, position = self.spool.read(self.batch_size)
+        if position is None:
+            self._stopping.wait(self.flush_interval)
+            return backoff
+        if not records:
+            # Only corrupt or torn data: nothing to deliver, but move past it
+            self.spool.ack(position, 0)
+            return backoff
+
+        try:
+            delivered = self._send(list(records))
+        except requests.RequestException:
+            delivered = False
+
+        if delivered:
+            self.spool.ack(position, len(records))
+            self._count('sent', len(records))
+            return self.flush_interval
+        self._stopping.wait(backoff)
+        return min(backoff * 2, LOG_SPOOL_REPLAY_MAX_BACKOFF)
+
+    def _post(self, url, payload):
+        response = self._session.post(url, json=payload, timeout=LOG_REQUEST_TIMEOUT)
+        return response.status_code
+
+    def _send(self, batch):
+        """Send a batch once; returns True when the server accepted it"""
+        if self.bulk_supported and len(batch) > 1:
+            status = self._post(self.bulk_url, {'logs': batch})
+            if status != 404:
+                return 200 <= status < 300
+            logger.warning("Bulk log endpoint not available, falling back to single posts")
+            self.bulk_supported = False
+
+        # Records posted here are removed, so a retry only resends what is left
+        while batch:
+            status = self._post(self.single_url, batch[0])
+            if not 200 <= status < 300:
+                return False
+            batch.pop(0)
+        return True
+
+    def _ship(self, batch):
+        """Send a batch, retrying with exponential backoff; on failure batch holds the unsent records"""
+        self._count('batches')
+        for attempt in range(LOG_MAX_RETRIES + 1):
+            if attempt:
+                self._count('retries')
+                time.sleep(LOG_RETRY_BACKOFF * 2 ** (attempt - 1))
+            pending = len(batch)
+            try:
+                delivered = self._send(batch)
+            except requests.RequestException as e:
+                logger.debug("Error sending %d logs to server: %s", pending, e)
+                delivered = False
+            self._count('sent', pending - len(batch) if not delivered else pending)
+            if delivered:
+                return True
+
+        logger.warning("Could not deliver %d attention logs after %d attempts", len(batch), LOG_MAX_RETRIES + 1)
+        return False
+
+    def close(self, timeout=5):
+        """Stop the workers after the queued records have been shipped"""
+        if self._pid != os.getpid():
+            return
+        self._queue.put(None)
+        self._stopping.set()
+        deadline = time.monotonic() + timeout
+        for thread in self._threads:
+            thread.join(max(0, deadline - time.monotonic()))
+        if self.spool is not None:
+            self.spool.close()
+        self._pid = None
+
+    def stats(self):
+        """Shipper counters for monitoring"""
+        with self._counters_lock:
+            stats = dict(self.counters)
+        stats['queued'] = self._queue.qsize() if self._queue is not None else 0
+        stats['bulk_supported'] = self.bulk_supported
+        stats['spool'] = self.spool.stats() if self.spool is not None else None
+        return stats
+
+log_shipper = LogShipper(NODE_SERVER_URL)
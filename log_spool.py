@@ -0,0 +1,248 @@
+import os
+import json
+import time
+import logging
+import tempfile
+import threading
+
+try:
+    import fcntl
+    FCNTL_AVAILABLE = True
+except ImportError:
+    FCNTL_AVAILABLE = False
+
+logger = logging.getLogger(__name__)
+
+# Root directory for spooled attention logs; each process claims its own slot below it
+LOG_SPOOL_DIR = os.environ.get('LOG_SPOOL_DIR', os.path.join(tempfile.gettempdir(), 'attention-log-spool'))
+
+# Segment files roll over at this size; the oldest segments are evicted past the total cap
+LOG_SPOOL_SEGMENT_BYTES = int(os.environ.get('LOG_SPOOL_SEGMENT_BYTES', 4 * 1024 * 1024))
+LOG_SPOOL_MAX_BYTES = int(os.environ.get('LOG_SPOOL_MAX_BYTES', 256 * 1024 * 1024))
+
+# Appends are fsynced at most this often (seconds), not once per record
+LOG_SPOOL_FSYNC_INTERVAL = float(os.environ.get('LOG_SPOOL_FSYNC_INTERVAL', 1.0))
+
+SEGMENT_SUFFIX = '.jsonl'
+CURSOR_FILE = 'cursor'
+
+class LogSpool:
+    """Append-only, segmented on-disk queue of JSON records"""
+
+    def __init__(self, directory, segment_bytes=LOG_SPOOL_SEGMENT_BYTES, max_bytes=LOG_SPOOL_MAX_BYTES,
+                 fsync_interval=LOG_SPOOL_FSYNC_INTERVAL):
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.max_bytes = max_bytes
+        self.fsync_interval = fsync_interval
+        self._lock = threading.Lock()
+        self._lock_file = None
+        self._writer = None
+        self._writer_seq = None
+        self._dirty = False
+        self._last_sync = time.monotonic()
+        self.counters = {
+            'spooled': 0,
+            'replayed': 0,
+            'evicted_segments': 0,
+            'evicted_bytes': 0,
+            'corrupt': 0
+        }
+
+        os.makedirs(directory, exist_ok=True)
+        self._sizes = {seq: os.path.getsize(self._path(seq)) for seq in self._scan()}
+        self._read_seq, self._read_offset = self._load_cursor()
+
+    @classmethod
+    def claim(cls, root=LOG_SPOOL_DIR, **kwargs):
+        """Open the first spool slot under root not held by another live process"""
+        os.makedirs(root, exist_ok=True)
+        if not FCNTL_AVAILABLE:
+            return cls(os.path.join(root, f'pid-{os.getpid()}'), **kwargs)
+
+        slot = 0
+        while True:
+            directory = os.path.join(root, f'slot-{slot}')
+            os.makedirs(directory, exist_ok=True)
+            lock_file = open(os.path.join(directory, '.lock'), 'w')
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                lock_file.close()
+                slot += 1
+                continue
+            # A slot left behind by a previous process is resumed, so its records are replayed
+            spool = cls(directory, **kwargs)
+            spool._lock_file = lock_file
+            return spool
+
+    def _path(self, seq):
+        return os.path.join(self.directory, f'{seq:012d}{SEGMENT_SUFFIX}')
+
+    def _scan(self):
+        return sorted(
+            int(name[:-len(SEGMENT_SUFFIX)]) for name in os.listdir(self.directory)
+            if name.endswith(SEGMENT_SUFFIX) and name[:-len(SEGMENT_SUFFIX)].isdigit()
+        )
+
+    def _load_cursor(self):
+        """Resume reading where the last acknowledged batch ended"""
+        try:
+            with open(os.path.join(self.directory, CURSOR_FILE)) as cursor:
+                seq, offset = (int(value) for value in cursor.read().split())
+        except (OSError, ValueError):
+            seq, offset = None, 0
+        if seq not in self._sizes:
+            return (min(self._sizes) if self._sizes else None), 0
+        return seq, offset
+
+    def _save_cursor(self):
+        # Not fsynced: losing it after a crash only means replaying a batch twice
+        path = os.path.join(self.directory, CURSOR_FILE)
+        with open(path + '.tmp', 'w') as cursor:
+            cursor.write(f'{self._read_seq} {self._read_offset}')
+        os.replace(path + '.tmp', path)
+
+    def _sync(self):
+        if self._writer is not None and self._dirty:
+            self._writer.flush()
+            os.fsync(self._writer.fileno())
+            self._dirty = False
+        self._last_sync = time.monotonic()
+
+    def _close_writer(self):
+        if self._writer is not None:
+            self._sync()
+            self._writer.close()
+            self._writer = None
+            self._writer_seq = None
+
+    def _remove_segment(self, seq):
+        if seq == self._writer_seq:
+            self._close_writer()
+        size = self._sizes.pop(seq)
+        try:
+            os.remove(self._path(seq))
+        except FileNotFoundError:
+            pass
+        if seq == self._read_seq:
+            self._read_seq = min(self._sizes) if self._sizes else None
+            self._read_offset = 0
+        return size
+
+    def _evict(self):
+        """Drop the oldest segments until the spool fits its size cap"""
+        while sum(self._sizes.values()) > self.max_bytes and len(self._sizes) > 1:
+            size = self._remove_segment(min(self._sizes))
+            self.counters['evicted_segments'] += 1
+            self.counters['evicted_bytes'] += size
+            logger.warning("Log spool over %d bytes, evicted oldest segment (%d bytes)", self.max_bytes, size)
+
+    def append(self, records):
+        """Append records to the active segment; fsync is batched by time"""
+        data = ''.join(json.dumps(record, separators=(',', ':')) + '\n' for record in records).encode()
+        with self._lock:
+            if self._writer is not None and self._sizes[self._writer_seq] >= self.segment_bytes:
+                self._close_writer()
+            if self._writer is None:
+                self._writer_seq = max(self._sizes) + 1 if self._sizes else 0
+                self._writer = open(self._path(self._writer_seq), 'ab')
+                self._sizes[self._writer_seq] = 0
+                if self._read_seq is None:
+                    self._read_seq, self._read_offset = self._writer_seq, 0
+
+            self._writer.write(data)
+            self._sizes[self._writer_seq] += len(data)
+            self._dirty = True
+            self.counters['spooled'] += len(records)
+            if time.monotonic() - self._last_sync >= self.fsync_interval:
+                self._sync()
+            self._evict()
+
+    def sync(self):
+        """Fsync pending appends if the interval has passed; called from the replay loop"""
+        with self._lock:
+            if self._dirty and time.monotonic() - self._last_sync >= self.fsync_interval:
+                self._sync()
+
+    def pending(self):
+        """Whether any unacknowledged records remain on disk"""
+        with self._lock:
+            return self._read_seq is not None and (
+                self._read_offset < self._sizes[self._read_seq] or len(self._sizes) > 1
+            )
+
+    def read(self, max_records):
+        """Return (records, position) for the oldest unacknowledged records, in append order, or ([], None)"""
+        with self._lock:
+            while self._read_seq is not None:
+                if self._read_offset < self._sizes[self._read_seq]:
+                    break
+                if self._read_seq == self._writer_seq:
+                    return [], None
+                # Fully acknowledged segment
+                self._remove_segment(self._read_seq)
+            else:
+                return [], None
+
+            seq, offset = self._read_seq, self._read_offset
+            # Only the writer segment can still grow; anywhere else a partial line is a torn write
+            sealed = seq != self._writer_seq
+            if not sealed:
+                self._writer.flush()
+
+        start = offset
+        records = []
+        try:
+            segment = open(self._path(seq), 'rb')
+        except FileNotFoundError:
+            # Evicted after the lock was released
+            return [], None
+        with segment:
+            segment.seek(offset)
+            while len(records) < max_records:
+                line = segment.readline()
+                if not line:
+                    break
+                if not line.endswith(b'\n'):
+                    if sealed:
+                        # Torn tail of a crashed write: skip it so replay can move on
+                        logger.warning("Skipping torn record at the end of log spool segment %d", seq)
+                        offset += len(line)
+                        self.counters['corrupt'] += 1
+                    break
+                offset += len(line)
+                try:
+                    records.append(json.loads(line))
+                except ValueError:
+                    logger.warning("Skipping corrupt record in log spool segment %d", seq)
+                    self.counters['corrupt'] += 1
+        # Corrupt or torn data still moves the position, so the caller must ack it even without records
+        return records, (seq, offset) if offset > start else None
+
+    def ack(self, position, count):
+        """Mark records returned by read() as delivered"""
+        seq, offset = position
+        with self._lock:
+            # The segment may have been evicted while the batch was in flight
+            if seq != self._read_seq:
+                return
+            self._read_offset = offset
+            self.counters['replayed'] += count
+            if offset >= self._sizes[seq] and seq != self._writer_seq:
+                self._remove_segment(seq)
+            self._save_cursor()
+
+    def close(self):
+        """Fsync and close the active segment"""
+        with self._lock:
+            self._close_writer()
+
+    def stats(self):
+        """Spool usage for monitoring"""
+        with self._lock:
+            stats = dict(self.counters)
+            stats['segments'] = len(self._sizes)
+            stats['bytes'] = sum(self._sizes.values())
+            stats['directory'] = self.directory
+        return stats
@@ -1,6 +1,9 @@
 import time
+import json
+import struct
 from collections import deque
 from enum import Enum
+import numpy as np
 
 # Attention state constants
 ATTENTIVE = "attentive"
@@ -11,6 +14,12 @@ SLEEPING = "sleeping"
 
 DARKNESS = "darkness"
 
+# Detection cascade stages, reported as the stage that decided the state
+STAGE_LUMINANCE = "luminance"
+STAGE_FACE_DETECTION = "face_detection"
+STAGE_LANDMARKS = "landmarks"
+STAGE_FRAME_CACHE = "frame_cache"
+
 class AttentionCategory(Enum):
     ATTENTIVE = "attentive"
     DISTRACTED = "distracted"
@@ -25,7 +34,57 @@ class AttentionState(Enum):
     SLEEPING = SLEEPING
     DARKNESS = DARKNESS
 
+# Per-frame measurement fields, in the column order of the measurement ring buffers
+MEASUREMENT_FIELDS = (
+    'brightness', 'contrast', 'face_presence', 'eye_openness',
+    'looking_score', 'drowsiness_score', 'sleeping_score', 'timestamp'
+)
+MEASUREMENT_COLUMNS = {name: index for index, name in enumerate(MEASUREMENT_FIELDS)}
+
+# States are stored as small integer codes in the state history buffers
+STATE_CODES = {state.value: code for code, state in enumerate(AttentionState)}
+STATE_NAMES = tuple(state.value for state in AttentionState)
+
+# Ring buffer sizes per user
+MEASUREMENT_HISTORY_SIZE = 32
+STATE_HISTORY_SIZE = 10
+MAX_HISTORY_ENTRIES = 20
+
+class RingBuffer:
+    """Fixed-size NumPy ring buffer of rows, oldest overwritten first"""
+    __slots__ = ('data', 'size', 'next')
+
+    def __init__(self, capacity, width=None, dtype=np.float64):
+        shape = (capacity,) if width is None else (capacity, width)
+        self.data = np.zeros(shape, dtype=dtype)
+        self.size = 0
+        self.next = 0
+
+    def __len__(self):
+        return self.size
+
+    def append(self, row):
+        self.data[self.next] = row
+        self.next = (self.next + 1) % len(self.data)
+        if self.size < len(self.data):
+            self.size += 1
+
+    def last(self, n=None):
+        """The newest n rows (all by default), oldest first, as a copy"""
+        n = self.size if n is None else min(n, self.size)
+        indices = (self.next - n + np.arange(n)) % len(self.data)
+        return self.data[indices]
+
+    def latest(self):
+        """The newest row, or None when empty"""
+        if self.size == 0:
+            return None
+        return self.data[self.next - 1]
+
 class Measurement:
+    """One frame's scores; a row of the measurement buffer with named access"""
+    __slots__ = MEASUREMENT_FIELDS
+
     def __init__(self, brightness, contrast, face_presence, eye_openness, looking_score, drowsiness_score=0, sleeping_score=0, timestamp=None):
         self.brightness = brightness
         self.contrast = contrast
@@ -36,23 +95,188 @@ class Measurement:
         self.sleeping_score = sleeping_score
         self.timestamp = timestamp or time.time()
 
+    @classmethod
+    def from_row(cls, row):
+        return cls(*(float(value) for value in row))
+
+    def to_row(self):
+        return tuple(getattr(self, name) for name in MEASUREMENT_FIELDS)
+
+    def to_dict(self):
+        """Measurements as reported in API responses and attention logs"""
+        return {
+            'brightness': self.brightness,
+            'contrast': self.contrast,
+            'facePresence': self.face_presence,
+            'eyeOpenness': self.eye_openness,
+            'lookingScore': self.looking_score,
+            'drowsinessScore': self.drowsiness_score,
+            'sleepingScore': self.sleeping_score
+        }
+
+class TemporalState:
+    """Running per-user temporal filters, each updated in O(1) per frame"""
+    __slots__ = ('scores', 'updated_at', 'perclos_closed', 'perclos_weight', 'candidate', 'candidate_count')
+
+    def __init__(self):
+        # EWMA of every measurement column except the timestamp; None until the first face frame
+        self.scores = None
+        # Timestamp of the last measurement row folded into the filters
+        self.updated_at = 0.0
+        # Time-decayed eye-closure sums: closed/weight is the PERCLOS ratio, weight its window coverage
+        self.perclos_closed = 0.0
+        self.perclos_weight = 0.0
+        # A detected state waiting to be confirmed before it replaces the current one
+        self.candidate = None
+        self.candidate_count = 0
+
+    def to_list(self):
+        return [
+            self.scores.tolist() if self.scores is not None else None, self.updated_at,
+            self.perclos_closed, self.perclos_weight,
+            self.candidate, self.candidate_count
+        ]
+
+    @classmethod
+    def from_list(cls, values):
+        temporal = cls()
+        (scores, temporal.updated_at, temporal.perclos_closed, temporal.perclos_weight,
+         temporal.candidate, temporal.candidate_count) = values
+        if scores is not None:
+            temporal.scores = np.array(scores)
+        return temporal
+
 class UserAttentionData:
+    """All per-user detection state"""
+    __slots__ = (
+        'user_id', 'room_id', 'measurements', 'state_history', 'last_activity', 'current_state', 'state_since',
+        'history', 'temporal', 'cache_signature', 'cache_time', 'cache_state', 'cache_measurement'
+    )
+
     def __init__(self, user_id):
         self.user_id = user_id
-        self.measurements = deque(maxlen=5)
-        self.state_history = deque(maxlen=10)
-        self.calibration_images = []
+        self.room_id = None
+        self.measurements = RingBuffer(MEASUREMENT_HISTORY_SIZE, len(MEASUREMENT_FIELDS))
+        self.state_history = RingBuffer(STATE_HISTORY_SIZE, dtype=np.int8)
         self.last_activity = time.time()
-        self.current_state = ABSENT
+        self.current_state = None
         self.state_since = int(time.time() * 1000)
-        self.history = []
+        self.history = deque(maxlen=MAX_HISTORY_ENTRIES)
+        self.temporal = TemporalState()
+        # Frame-difference skip cache: last fully analyzed frame
+        self.cache_signature = None
+        self.cache_time = 0.0
+        self.cache_state = None
+        self.cache_measurement = None
+
+    def add_measurement(self, measurement):
+        self.measurements.append(measurement.to_row())
+
+    def latest_measurement(self):
+        row = self.measurements.latest()
+        return None if row is None else Measurement.from_row(row)
+
+    def recent_measurements(self, n):
+        """The newest n measurements, oldest first"""
+        return [Measurement.from_row(row) for row in self.measurements.last(n)]
+
+    def add_state(self, state):
+        self.state_history.append(STATE_CODES[state])
+
+    def recent_states(self, n=None):
+        return [STATE_NAMES[code] for code in self.state_history.last(n)]
+
+    def record_state(self, state, now_ms):
+        """Track the current state and close the previous state's history entry"""
+        self.last_activity = time.time()
+        if self.current_state is None:
+            self.current_state = state
+            self.state_since = now_ms
+            return
+
+        if self.current_state != state:
+            duration = (now_ms - self.state_since) / 1000.0
+            if duration > 1:
+                self.history.append({
+                    "state": self.current_state,
+                    "start_time": self.state_since,
+                    "end_time": now_ms,
+                    "duration": duration
+                })
+            self.current_state = state
+            self.state_since = now_ms
+
+    def to_bytes(self):
+        """Compact serialization for shared state backends: JSON header followed by raw buffers"""
+        signature = self.cache_signature
+        header = json.dumps({
+            'user_id': self.user_id,
+            'room_id': self.room_id,
+            'measurements': [self.measurements.size, self.measurements.next],
+            'states': [self.state_history.size, self.state_history.next],
+            'last_activity': self.last_activity,
+            'current_state': self.current_state,
+            'state_since': self.state_since,
+            'history': list(self.history),
+            'temporal': self.temporal.to_list(),
+            'cache': [
+                self.cache_time, self.cache_state,
+                self.cache_measurement.to_row() if self.cache_measurement is not None else None,
+                list(signature.shape) if signature is not None else None
+            ]
+        }, separators=(',', ':')).encode()
+        parts = [struct.pack('<I', len(header)), header,
+                 self.measurements.data.tobytes(), self.state_history.data.tobytes()]
+        if signature is not None:
+            parts.append(np.ascontiguousarray(signature, dtype=np.uint8).tobytes())
+        return b''.join(parts)
+
+    @classmethod
+    def from_bytes(cls, data):
+        (header_size,) = struct.unpack_from('<I', data)
+        offset = 4 + header_size
+        header = json.loads(data[4:offset])
+
+        user_data = cls(header['user_id'])
+        user_data.room_id = header.get('room_id')
+        for ring, (size, next_index) in ((user_data.measurements, header['measurements']),
+                                         (user_data.state_history, header['states'])):
+            end = offset + ring.data.nbytes
+            ring.data[...] = np.frombuffer(data[offset:end], dtype=ring.data.dtype).reshape(ring.data.shape)
+            ring.size, ring.next = size, next_index
+            offset = end
+
+        user_data.last_activity = header['last_activity']
+        user_data.current_state = header['current_state']
+        user_data.state_since = header['state_since']
+        user_data.history.extend(header['history'])
+        if header.get('temporal') is not None:
+            user_data.temporal = TemporalState.from_list(header['temporal'])
+
+        cache_time, cache_state, cache_row, signature_shape = header['cache']
+        user_data.cache_time = cache_time
+        user_data.cache_state = cache_state
+        if cache_row is not None:
+            user_data.cache_measurement = Measurement(*cache_row)
+        if signature_shape is not None:
+            user_data.cache_signature = np.frombuffer(data[offset:], dtype=np.uint8).reshape(signature_shape).copy()
+        return user_data
 
 class UserCalibration:
-    def __init__(self, user_id):
+    __slots__ = ('user_id', 'brightness_baseline', 'contrast_baseline', 'time')
+
+    def __init__(self, user_id, brightness_baseline=0, contrast_baseline=0, calibrated_at=None):
         self.user_id = user_id
-        self.brightness_baseline = 0
-        self.contrast_baseline = 0
-        self.time = time.time()
+        self.brightness_baseline = brightness_baseline
+        self.contrast_baseline = contrast_baseline
+        self.time = calibrated_at or time.time()
+
+    def to_bytes(self):
+        return struct.pack('<ddd', self.brightness_baseline, self.contrast_baseline, self.time)
+
+    @classmethod
+    def from_bytes(cls, user_id, data):
+        return cls(user_id, *struct.unpack('<ddd', data))
 
 class AttentionResponse:
     def __init__(self, user_id, attention_state, attention_percentage, confidence, timestamp=None):
@@ -86,17 +310,21 @@ class AttentionResponse:
         }
 
 class RoomAttentionResponse:
-    def __init__(self, room_id, attention_data, timestamp=None):
+    def __init__(self, room_id, attention_data, timestamp=None, summary=None):
         self.room_id = room_id
         self.attention = attention_data
         self.timestamp = timestamp or int(time.time() * 1000)
+        self.summary = summary
     
     def to_dict(self):
-        return {
+        response = {
             'roomId': self.room_id,
             'attention': self.attention,
             'timestamp': self.timestamp
         }
+        if self.summary is not None:
+            response['summary'] = self.summary
+        return response
 
 class CalibrationResponse:
     def __init__(self, user_id, success, timestamp=None):
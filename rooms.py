@@ -0,0 +1,256 @@
+import os
+import json
+import time
+import queue
+import hashlib
+import threading
+from models import AttentionState, AttentionCategory, RoomAttentionResponse
+
+# A member's record in the room aggregate is refreshed when the state changes, or when
+# the reported confidence moves by at least this many points
+ROOM_CONFIDENCE_DELTA = float(os.environ.get('ROOM_CONFIDENCE_DELTA', 5.0))
+
+# Room streams: events buffered per subscriber before it is considered too slow and dropped,
+# and seconds between keepalive comments (the number of open streams is capped in admission.py)
+ROOM_STREAM_QUEUE_SIZE = int(os.environ.get('ROOM_STREAM_QUEUE_SIZE', 256))
+ROOM_STREAM_KEEPALIVE = float(os.environ.get('ROOM_STREAM_KEEPALIVE', 15))
+
+STATE_NAMES = [state.value for state in AttentionState]
+CATEGORY_NAMES = [category.value for category in AttentionCategory]
+
+def parse_user_ids(values):
+    """Member ids from repeated and/or comma-separated userIds query values"""
+    return [user_id.strip() for value in values for user_id in value.split(',') if user_id.strip()]
+
+def summarize_attention(attention):
+    """Counts per state and category plus mean percentage for a map of member records"""
+    state_counts = dict.fromkeys(STATE_NAMES, 0)
+    category_counts = dict.fromkeys(CATEGORY_NAMES, 0)
+    percentage_total = 0
+    for record in attention.values():
+        state_counts[record['attentionState']] = state_counts.get(record['attentionState'], 0) + 1
+        category_counts[record['attentionCategory']] = category_counts.get(record['attentionCategory'], 0) + 1
+        percentage_total += record['attentionPercentage']
+    return {
+        'members': len(attention),
+        'stateCounts': state_counts,
+        'categoryCounts': category_counts,
+        'meanAttentionPercentage': round(percentage_total / len(attention), 1) if attention else 0.0
+    }
+
+class RoomAggregate:
+    """Latest record of every member plus running counts, serialized at most once per change"""
+    __slots__ = ('room_id', 'members', 'state_counts', 'category_counts', 'percentage_total',
+                 'version', 'updated_at', '_snapshot')
+
+    def __init__(self, room_id):
+        self.room_id = room_id
+        self.members = {}
+        self.state_counts = dict.fromkeys(STATE_NAMES, 0)
+        self.category_counts = dict.fromkeys(CATEGORY_NAMES, 0)
+        self.percentage_total = 0
+        self.version = 0
+        self.updated_at = int(time.time() * 1000)
+        self._snapshot = None
+
+    def _count(self, record, sign):
+        self.state_counts[record['attentionState']] += sign
+        self.category_counts[record['attentionCategory']] += sign
+        self.percentage_total += sign * record['attentionPercentage']
+
+    def _changed(self):
+        self.version += 1
+        self.updated_at = int(time.time() * 1000)
+        self._snapshot = None
+
+    def needs_update(self, user_id, record):
+        current = self.members.get(user_id)
+        return (
+            current is None
+            or current['attentionState'] != record['attentionState']
+            or current['stateSince'] != record['stateSince']
+            or abs(current['confidence'] - record['confidence']) >= ROOM_CONFIDENCE_DELTA
+        )
+
+    def update(self, user_id, record):
+        current = self.members.get(user_id)
+        if current is not None:
+            self._count(current, -1)
+        self.members[user_id] = record
+        self._count(record, 1)
+        self._changed()
+
+    def remove(self, user_id):
+        record = self.members.pop(user_id, None)
+        if record is not None:
+            self._count(record, -1)
+            self._changed()
+
+    def summary(self):
+        members = len(self.members)
+        return {
+            'members': members,
+            'stateCounts': dict(self.state_counts),
+            'categoryCounts': dict(self.category_counts),
+            'meanAttentionPercentage': round(self.percentage_total / members, 1) if members else 0.0
+        }
+
+    def snapshot(self):
+        """(json_bytes, unquoted etag) of the whole room, rebuilt only after a change"""
+        if self._snapshot is None:
+            response = RoomAttentionResponse(self.room_id, dict(self.members), self.updated_at, self.summary())
+            body = json.dumps(response.to_dict(), separators=(',', ':')).encode()
+            etag = hashlib.md5(body).hexdigest()[:16]
+            self._snapshot = (body, etag)
+        return self._snapshot
+
+class RoomSubscriber:
+    """Bounded event queue of one stream client"""
+    __slots__ = ('room_id', 'events', 'dropped')
+
+    def __init__(self, room_id, queue_size=ROOM_STREAM_QUEUE_SIZE):
+        self.room_id = room_id
+        self.events = queue.Queue(maxsize=queue_size)
+        self.dropped = False
+
+    def push(self, event):
+        """Queue an event; returns False once the subscriber has fallen too far behind"""
+        try:
+            self.events.put_nowait(event)
+            return True
+        except queue.Full:
+            self.dropped = True
+            return False
+
+class RoomRegistry:
+    """Per-room aggregates maintained incrementally as detections come in"""
+
+    def __init__(self):
+        self.rooms = {}
+        self.user_rooms = {}
+        self.subscribers = {}
+        self.subscriber_count = 0
+        self.dropped_subscribers = 0
+        self._lock = threading.Lock()
+
+    def _publish(self, room, event):
+        """Fan an event out to the room's subscribers, dropping any that cannot keep up"""
+        subscribers = self.subscribers.get(room.room_id)
+        if not subscribers:
+            return
+        event = dict(event, version=room.version, summary=room.summary())
+        for subscriber in list(subscribers):
+            if not subscriber.push(event):
+                self._unsubscribe(subscriber)
+                self.dropped_subscribers += 1
+
+    def _unsubscribe(self, subscriber):
+        subscribers = self.subscribers.get(subscriber.room_id)
+        if subscribers is not None and subscriber in subscribers:
+            subscribers.remove(subscriber)
+            self.subscriber_count -= 1
+            if not subscribers:
+                del self.subscribers[subscriber.room_id]
+
+    def subscribe(self, room_id):
+        """Register a stream client"""
+        with self._lock:
+            subscriber = RoomSubscriber(room_id)
+            self.subscribers.setdefault(room_id, []).append(subscriber)
+            self.subscriber_count += 1
+            return subscriber
+
+    def unsubscribe(self, subscriber):
+        with self._lock:
+            self._unsubscribe(subscriber)
+
+    def record(self, room_id, user_id, record):
+        """Store a member's latest record; returns True when the room changed"""
+        with self._lock:
+            previous_room_id = self.user_rooms.get(user_id)
+            if previous_room_id is not None and previous_room_id != room_id:
+                self._remove(previous_room_id, user_id)
+            self.user_rooms[user_id] = room_id
+            room = self.rooms.get(room_id)
+            if room is None:
+                room = self.rooms[room_id] = RoomAggregate(room_id)
+            current = room.members.get(user_id)
+            if not room.needs_update(user_id, record):
+                return False
+            room.update(user_id, record)
+            # Streams only carry state changes; confidence drift is left to snapshots
+            if (current is None or current['attentionState'] != record['attentionState']
+                    or current['stateSince'] != record['stateSince']):
+                self._publish(room, {'type': 'member', 'userId': user_id, 'record': record})
+            return True
+
+    def _remove(self, room_id, user_id):
+        room = self.rooms.get(room_id)
+        if room is None or user_id not in room.members:
+            return
+        room.remove(user_id)
+        self._publish(room, {'type': 'leave', 'userId': user_id})
+        if not room.members:
+            del self.rooms[room_id]
+
+    def remove_user(self, user_id):
+        """Drop an expired or removed user from its room"""
+        with self._lock:
+            room_id = self.user_rooms.pop(user_id, None)
+            if room_id is not None:
+                self._remove(room_id, user_id)
+
+    def member_records(self, room_id, user_ids):
+        """Records of the listed users known to the room, skipping the rest"""
+        with self._lock:
+            room = self.rooms.get(room_id)
+            if room is None:
+                return {}
+            return {user_id: room.members[user_id] for user_id in user_ids if user_id in room.members}
+
+    def snapshot(self, room_id):
+        """(json_bytes, etag) for a room, or None when it has no members here"""
+        with self._lock:
+            room = self.rooms.get(room_id)
+            return room.snapshot() if room is not None else None
+
+    def stats(self):
+        with self._lock:
+            return {
+                'rooms': len(self.rooms),
+                'members': sum(len(room.members) for room in self.rooms.values()),
+                'stream_subscribers': self.subscriber_count,
+                'dropped_subscribers': self.dropped_subscribers
+            }
+
+def format_sse(event, data, event_id=None):
+    """Encode one Server-Sent Events message"""
+    lines = [f'event: {event}']
+    if event_id is not None:
+        lines.append(f'id: {event_id}')
+    lines.append(f'data: {data}')
+    return '\n'.join(lines) + '\n\n'
+
+def stream_room(subscriber, snapshot):
+    """SSE generator: the current snapshot, then deltas and keepalives until the client goes away"""
+    try:
+        yield format_sse('snapshot', snapshot.decode() if snapshot else json.dumps({
+            'roomId': subscriber.room_id, 'attention': {}, 'summary': summarize_attention({})
+        }))
+        while True:
+            try:
+                event = subscriber.events.get(timeout=ROOM_STREAM_KEEPALIVE)
+            except queue.Empty:
+                if subscriber.dropped:
+                    break
+                yield ': keepalive\n\n'
+                continue
+            yield format_sse('delta', json.dumps(event, separators=(',', ':')), event['version'])
+            if subscriber.dropped and subscriber.events.empty():
+                break
+        # Too slow: the client should reconnect and start again from a fresh snapshot
+        yield format_sse('dropped', json.dumps({'reason': 'slow consumer'}))
+    finally:
+        room_registry.unsubscribe(subscriber)
+
+room_registry = RoomRegistry()
@@ -2,100 +2,311 @@ import os
 import time
 import sys
 import gc
-import traceback
-import requests
-from flask import Flask, request, jsonify
+import json
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from flask import Flask, Response, request, jsonify, g
 from flask_cors import CORS
+from app_logging import configure_logging, get_dropped_log_count
+
+configure_logging()
+logger = logging.getLogger(__name__)
 
 try:
     import psutil
     PSUTIL_AVAILABLE = True
 except ImportError:
     PSUTIL_AVAILABLE = False
-    print("Warning: psutil not available. Memory monitoring will be limited.")
+    logger.warning("psutil not available. Memory monitoring will be limited.")
 
-from utils import decode_base64_image, get_user_attention_data, get_user_calibration, set_user_calibration
-from detection import process_attention_request, calibrate_user, get_room_attention_data
+try:
+    from flask_sock import Sock, ConnectionClosed
+    FLASK_SOCK_AVAILABLE = True
+except ImportError:
+    FLASK_SOCK_AVAILABLE = False
+
+from utils import decode_image_data, InvalidFrameError, get_user_count, get_calibration_count, tune_gc, is_state_shared
+from detection import (
+    process_attention_request, calibrate_user, get_room_attention_data, get_room_snapshot, get_frame_cache_stats
+)
 from models import AttentionResponse, RoomAttentionResponse, CalibrationResponse
+from detectors import detector_pool
+from log_shipper import log_shipper
+from rooms import room_registry, stream_room, parse_user_ids
+from admission import (
+    admission_controller, connection_limiter, AdmissionError, deadline_from_header, DEADLINE_HEADER
+)
 
 app = Flask(__name__)
 CORS(app)
+sock = Sock(app) if FLASK_SOCK_AVAILABLE else None
 
-def send_log_to_server(log_data):
-    """Send attention log to Node.js server"""
-    try:
-        node_server_url = os.environ.get('NODE_SERVER_URL', 'http://localhost:3001')
-        response = requests.post(
-            f"{node_server_url}/api/logs/attention",
-            json=log_data,
-            timeout=5
-        )
-        if response.status_code != 201:
-            print(f"Warning: Failed to send log to server. Status: {response.status_code}")
-    except Exception as e:
-        print(f"Error sending log to server: {str(e)}")
+tune_gc()
+
+# Batch detection fans items out over as many threads as there are detector sets
+BATCH_MAX_ITEMS = int(os.environ.get('BATCH_MAX_ITEMS', 64))
+batch_executor = ThreadPoolExecutor(max_workers=detector_pool.size, thread_name_prefix='batch-detect')
+
+# Metadata headers accepted with raw binary frame uploads
+FRAME_METADATA_HEADERS = {
+    'userId': 'X-User-Id',
+    'userName': 'X-User-Name',
+    'meetingId': 'X-Meeting-Id',
+    'sessionId': 'X-Session-Id',
+    'roomId': 'X-Room-Id'
+}
+
+def read_frame_request():
+    """Read metadata and image from a JSON (base64), multipart or raw binary request"""
+    mimetype = request.mimetype
+    
+    if mimetype == 'multipart/form-data':
+        data = request.args.to_dict()
+        data.update(request.form.to_dict())
+        upload = request.files.get('image')
+        return data, upload.read() if upload else None
+    
+    if mimetype == 'application/octet-stream' or mimetype.startswith('image/'):
+        data = {
+            field: request.headers[header]
+            for field, header in FRAME_METADATA_HEADERS.items()
+            if header in request.headers
+        }
+        data.update(request.args.to_dict())
+        return data, request.get_data(cache=False) or None
+    
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict):
+        return None, None
+    return data, data.get('image')
+
+def run_attention_detection(data, image_data, deadline=None):
+    """Admit, decode and analyze a frame, then ship the log for one user"""
+    user_id = data['userId']
+    
+    # Admission comes first so shed frames are not even decoded
+    with admission_controller.admit(user_id, deadline):
+        cv_image = decode_image_data(image_data)
+        result = process_attention_request(cv_image, user_id, data.get('roomId'), deadline)
+    
+    # Add attention category
+    attention_category = "attentive"
+    if result['attentionState'] in ["looking_away", "drowsy"]:
+        attention_category = "distracted"
+    elif result['attentionState'] in ["absent", "darkness"]:
+        attention_category = "inactive"
+    
+    result['attentionCategory'] = attention_category
+    
+    # Send log to Node.js server if meeting data is provided
+    if 'meetingId' in data and 'sessionId' in data and 'roomId' in data:
+        log_data = {
+            'meetingId': data['meetingId'],
+            'userId': user_id,
+            'userName': data.get('userName', 'Anonymous'),
+            'attentionState': result['attentionState'],
+            'attentionPercentage': result['attentionPercentage'],
+            'confidence': result['confidence'],
+            'measurements': result.get('measurements', {}),
+            'sessionId': data['sessionId'],
+            'roomId': data['roomId']
+        }
+        
+        # Shipped in batches by background workers; dropped (and counted) if the queue is full
+        log_shipper.submit(log_data)
+    
+    return result
+
+def request_deadline():
+    """Deadline of the current request from its optional X-Deadline-Ms header"""
+    return deadline_from_header(request.headers.get(DEADLINE_HEADER))
+
+def admission_error_response(error):
+    """HTTP response for a frame refused by admission control"""
+    headers = {'Retry-After': str(error.retry_after)} if error.retry_after is not None else {}
+    return jsonify({'error': str(error)}), error.status, headers
 
 @app.route('/api/detect_attention', methods=['POST'])
 def api_detect_attention():
     """Main attention detection endpoint"""
-    data = request.json
+    deadline = request_deadline()
+    data, image_data = read_frame_request()
     
-    if not data or 'image' not in data or 'userId' not in data:
+    if not data or not image_data or 'userId' not in data:
         return jsonify({'error': 'Missing required data'}), 400
     
     try:
-        pil_image, cv_image = decode_base64_image(data['image'])
-        user_id = data['userId']
-        
-        result = process_attention_request(pil_image, cv_image, user_id)
-        
-        # Add attention category
-        attention_category = "attentive"
-        if result['attentionState'] in ["looking_away", "drowsy"]:
-            attention_category = "distracted"
-        elif result['attentionState'] in ["absent", "darkness"]:
-            attention_category = "inactive"
-        
-        result['attentionCategory'] = attention_category
-        
-        # Send log to Node.js server if meeting data is provided
-        if 'meetingId' in data and 'sessionId' in data and 'roomId' in data:
-            log_data = {
-                'meetingId': data['meetingId'],
-                'userId': user_id,
-                'userName': data.get('userName', 'Anonymous'),
-                'attentionState': result['attentionState'],
-                'attentionPercentage': result['attentionPercentage'],
-                'confidence': result['confidence'],
-                'measurements': result.get('measurements', {}),
-                'sessionId': data['sessionId'],
-                'roomId': data['roomId']
-            }
-            
-            # Send log asynchronously
-            import threading
-            threading.Thread(target=send_log_to_server, args=(log_data,)).start()
-        
-        return jsonify(result)
+        return jsonify(run_attention_detection(data, image_data, deadline))
+    
+    except AdmissionError as e:
+        return admission_error_response(e)
+    
+    except InvalidFrameError as e:
+        return jsonify({'error': str(e)}), 400
     
     except Exception as e:
-        print(f"Error in detect_attention: {str(e)}")
-        print(traceback.format_exc())
+        logger.exception("Error in detect_attention: %s", e)
         return jsonify({'error': str(e)}), 500
 
+def detect_batch_item(item, deadline=None):
+    """Run detection for one batch item, reporting failures in the item result"""
+    user_id = item.get('userId')
+    if not user_id or not item.get('image'):
+        return {'userId': user_id, 'status': 400, 'error': 'Missing required data'}
+    
+    try:
+        result = run_attention_detection(item, item['image'], deadline)
+        result['status'] = 200
+        return result
+    
+    except AdmissionError as e:
+        return {'userId': user_id, 'status': e.status, 'error': str(e)}
+    
+    except InvalidFrameError as e:
+        return {'userId': user_id, 'status': 400, 'error': str(e)}
+    
+    except Exception as e:
+        logger.exception("Error in detect_attention batch for user %s: %s", user_id, e)
+        return {'userId': user_id, 'status': 500, 'error': str(e)}
+
+@app.route('/api/detect_attention/batch', methods=['POST'])
+def api_detect_attention_batch():
+    """Detect attention for many users' frames in one call"""
+    data = request.get_json(silent=True)
+    items = data.get('items') if isinstance(data, dict) else None
+    
+    if not isinstance(items, list) or not items:
+        return jsonify({'error': 'Missing required data'}), 400
+    
+    if len(items) > BATCH_MAX_ITEMS:
+        return jsonify({'error': f'Batch exceeds {BATCH_MAX_ITEMS} items'}), 413
+    
+    # Top-level fields such as meetingId/sessionId/roomId apply to every item
+    shared = {key: value for key, value in data.items() if key != 'items'}
+    batch = [{**shared, **item} if isinstance(item, dict) else {} for item in items]
+    
+    deadline = request_deadline()
+    results = list(batch_executor.map(lambda item: detect_batch_item(item, deadline), batch))
+    failed = sum(1 for result in results if result['status'] != 200)
+    
+    return jsonify({
+        'results': results,
+        'succeeded': len(results) - failed,
+        'failed': failed,
+        'timestamp': int(time.time() * 1000)
+    })
+
+# Session fields a WebSocket client sends once, before its frames
+FRAME_SESSION_FIELDS = ('userId', 'userName', 'meetingId', 'sessionId', 'roomId')
+
+# Seconds a WebSocket may stay silent before it is closed (0 waits forever)
+WS_IDLE_TIMEOUT = float(os.environ.get('WS_IDLE_TIMEOUT', 60))
+WS_PATH = '/api/detect_attention/ws'
+
+def receive_latest_frame(ws):
+    """Block for the next frame, then skip any that queued up behind it; returns (frame, skipped)"""
+    frame = ws.receive(timeout=WS_IDLE_TIMEOUT or None)
+    if frame is None:
+        return None, 0
+    skipped = 0
+    while True:
+        newer = ws.receive(timeout=0)
+        if newer is None:
+            return frame, skipped
+        frame = newer
+        skipped += 1
+
+def socket_frame_image(frame):
+    """Image of a socket frame: raw bytes, or a base64 text frame optionally wrapped as {"image": ...}"""
+    if not isinstance(frame, str) or not frame.startswith('{'):
+        return frame
+    try:
+        message = json.loads(frame)
+    except ValueError as e:
+        raise InvalidFrameError(f"Invalid frame message: {e}") from e
+    if not isinstance(message, dict) or not message.get('image'):
+        raise InvalidFrameError("Frame message has no image")
+    return message['image']
+
+def detect_attention_socket(ws):
+    """Persistent ingestion channel: a JSON session message, then frames answered with results"""
+    message = ws.receive(timeout=WS_IDLE_TIMEOUT or None)
+    if message is None:
+        ws.close()
+        return
+    try:
+        session = json.loads(message)
+    except (TypeError, ValueError):
+        session = None
+    
+    if not isinstance(session, dict) or not session.get('userId'):
+        ws.send(json.dumps({'type': 'error', 'error': 'Missing required data'}))
+        ws.close()
+        return
+    
+    data = {field: session[field] for field in FRAME_SESSION_FIELDS if field in session}
+    ws.send(json.dumps({'type': 'ready', 'userId': data['userId']}))
+    
+    while True:
+        # Frames that arrived during the previous inference are stale; only the newest is analyzed
+        frame, skipped = receive_latest_frame(ws)
+        if frame is None:
+            ws.send(json.dumps({'type': 'error', 'error': 'Idle timeout', 'status': 408}))
+            ws.close()
+            return
+        
+        try:
+            result = run_attention_detection(data, socket_frame_image(frame))
+            result['type'] = 'result'
+            result['skippedFrames'] = skipped
+        except AdmissionError as e:
+            result = {'type': 'error', 'error': str(e), 'status': e.status, 'retryAfter': e.retry_after}
+        except InvalidFrameError as e:
+            # The client's mistake, not ours: report it without a traceback
+            result = {'type': 'error', 'error': str(e), 'status': 400, 'skippedFrames': skipped}
+        except Exception as e:
+            logger.exception("Error in detect_attention socket for user %s: %s", data['userId'], e)
+            result = {'type': 'error', 'error': str(e), 'skippedFrames': skipped}
+        ws.send(json.dumps(result))
+
+if FLASK_SOCK_AVAILABLE:
+    @app.before_request
+    def limit_sockets():
+        """Refuse the WebSocket upgrade with 503 while this process is at its connection limit"""
+        if request.path != WS_PATH:
+            return None
+        # A socket holds a worker thread while open, like a room stream
+        if not connection_limiter.acquire():
+            return jsonify({'error': 'Too many open connections'}), 503, {'Retry-After': '5'}
+        g.holds_connection = True
+        return None
+    
+    @app.teardown_request
+    def release_socket(error=None):
+        if g.pop('holds_connection', False):
+            connection_limiter.release()
+    
+    @sock.route(WS_PATH)
+    def api_detect_attention_socket(ws):
+        """WebSocket frame ingestion endpoint (requires flask-sock)"""
+        try:
+            detect_attention_socket(ws)
+        except ConnectionClosed:
+            pass
+
 @app.route('/api/calibrate', methods=['POST'])
 def api_calibrate():
     """User calibration endpoint"""
-    data = request.json
+    data, image_data = read_frame_request()
     
-    if not data or 'image' not in data or 'userId' not in data:
+    if not data or not image_data or 'userId' not in data:
         return jsonify({'error': 'Missing required data'}), 400
     
     try:
-        pil_image, cv_image = decode_base64_image(data['image'])
+        cv_image = decode_image_data(image_data)
         user_id = data['userId']
         
-        success = calibrate_user(pil_image, cv_image, user_id)
+        success = calibrate_user(cv_image, user_id)
         current_timestamp = int(time.time() * 1000)
         
         response = CalibrationResponse(user_id, success, current_timestamp)
@@ -104,39 +315,78 @@ def api_calibrate():
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
-@app.route('/api/room_attention', methods=['POST'])
+@app.route('/api/room_attention', methods=['GET', 'POST'])
 def api_room_attention():
-    """Room attention endpoint for multiple users"""
-    data = request.json
+    """Room attention endpoint; without userIds the room's cached aggregate is served with an ETag"""
+    if request.method in ('GET', 'HEAD'):
+        data = request.args.to_dict()
+        if 'userIds' in request.args:
+            data['userIds'] = parse_user_ids(request.args.getlist('userIds'))
+    else:
+        data = request.get_json(silent=True)
     
-    if not data or 'roomId' not in data or 'userIds' not in data:
+    if not isinstance(data, dict) or 'roomId' not in data:
         return jsonify({'error': 'Missing required data'}), 400
     
     room_id = data['roomId']
-    user_ids = data['userIds']
+    user_ids = data.get('userIds')
+    if user_ids is not None and not isinstance(user_ids, list):
+        return jsonify({'error': 'userIds must be a list'}), 400
     
     try:
-        room_attention = get_room_attention_data(room_id, user_ids)
+        if user_ids is None:
+            snapshot = get_room_snapshot(room_id)
+            if snapshot is not None:
+                body, etag = snapshot
+                response = Response(status=304) if request.if_none_match.contains(etag) else \
+                    Response(body, mimetype='application/json')
+                response.set_etag(etag)
+                return response
+        
+        room_attention, summary = get_room_attention_data(room_id, user_ids)
         current_timestamp = int(time.time() * 1000)
         
-        response = RoomAttentionResponse(room_id, room_attention, current_timestamp)
+        response = RoomAttentionResponse(room_id, room_attention, current_timestamp, summary)
         return jsonify(response.to_dict())
     
     except Exception as e:
-        print(f"Error in room_attention: {str(e)}")
-        print(traceback.format_exc())
+        logger.exception("Error in room_attention: %s", e)
         return jsonify({'error': str(e)}), 500
 
+@app.route('/api/room_attention/stream', methods=['GET'])
+def api_room_attention_stream():
+    """Server-Sent Events stream of a room: a snapshot, then member state changes"""
+    room_id = request.args.get('roomId')
+    if not room_id:
+        return jsonify({'error': 'Missing required data'}), 400
+    
+    # Deltas come from this process's detections; with shared state members are served elsewhere too
+    if is_state_shared():
+        return jsonify({'error': 'Room streams are not available with shared state, poll /api/room_attention'}), 501
+    
+    # Each open stream holds a worker thread
+    if not connection_limiter.acquire():
+        return jsonify({'error': 'Too many open streams'}), 503, {'Retry-After': '5'}
+    
+    # Subscribe before taking the snapshot so no change falls between the two
+    subscriber = room_registry.subscribe(room_id)
+    snapshot = get_room_snapshot(room_id)
+    response = Response(
+        stream_room(subscriber, snapshot[0] if snapshot else None),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
+    response.call_on_close(connection_limiter.release)
+    return response
+
 @app.route('/api/test', methods=['GET'])
 def test_endpoint():
     """Test endpoint to verify server is running"""
-    from utils import user_attention_data
-    
     return jsonify({
         'status': 'ok',
         'message': 'Attention server is running',
         'timestamp': int(time.time() * 1000),
-        'user_count': len(user_attention_data)
+        'user_count': get_user_count()
     })
 
 @app.route('/api/health', methods=['GET'])
@@ -150,27 +400,39 @@ def health_check():
         memory_info = process.memory_info()
         memory_mb = memory_info.rss / 1024 / 1024
         
-        # Force garbage collection
-        gc.collect()
+        # Full collections stall every thread, so only run one when explicitly asked (?gc=1)
+        if request.args.get('gc') == '1':
+            gc.collect()
         
         # Get memory after GC
         memory_after_gc = process.memory_info().rss / 1024 / 1024
     else:
         memory_mb = 0
         memory_after_gc = 0
-        # Force garbage collection even without psutil
-        gc.collect()
+        if request.args.get('gc') == '1':
+            gc.collect()
     
-    from utils import user_attention_data, user_calibration, last_cleanup_time
+    from utils import last_cleanup_time
+    from detectors import tracker_sessions
     
     return jsonify({
         'status': 'ok', 
         'timestamp': current_timestamp,
-        'users_tracked': len(user_attention_data),
+        'users_tracked': get_user_count(),
         'memory_usage_mb': round(memory_mb, 2) if PSUTIL_AVAILABLE else 'psutil_not_available',
         'memory_after_gc_mb': round(memory_after_gc, 2) if PSUTIL_AVAILABLE else 'psutil_not_available',
-        'calibration_users': len(user_calibration),
+        'calibration_users': get_calibration_count(),
         'last_cleanup': last_cleanup_time,
+        'detector_pool': detector_pool.stats(),
+        'tracker_sessions': tracker_sessions.stats(),
+        'frame_cache': get_frame_cache_stats(),
+        'rooms': room_registry.stats(),
+        'admission': admission_controller.stats(),
+        'connections': connection_limiter.stats(),
+        'dropped_log_records': get_dropped_log_count(),
+        'log_shipper': log_shipper.stats(),
+        'gc_counts': gc.get_count(),
+        'websocket_available': FLASK_SOCK_AVAILABLE,
         'psutil_available': PSUTIL_AVAILABLE
     })
 
@@ -180,5 +442,5 @@ def create_app():
 
 if __name__ == '__main__':
     port = int(os.environ.get('PORT', 5000))
-    print("Using Python version:", sys.version)
-    app.run(host='0.0.0.0', port=port, debug=True, threaded=True) 
\ No newline at end of file
+    logger.info("Using Python version: %s", sys.version)
+    app.run(host='0.0.0.0', port=port, debug=os.environ.get('FLASK_DEBUG', '0') == '1', threaded=True) 
\ No newline at end of file
@@ -0,0 +1,51 @@
+import os
+from models import ATTENTIVE, LOOKING_AWAY, ABSENT, DROWSY, SLEEPING, DARKNESS
+from admission import admission_controller
+
+# Bounds of the next-frame interval suggested to clients, in milliseconds
+SAMPLING_MIN_INTERVAL_MS = int(os.environ.get('SAMPLING_MIN_INTERVAL_MS', 250))
+SAMPLING_MAX_INTERVAL_MS = int(os.environ.get('SAMPLING_MAX_INTERVAL_MS', 3000))
+
+# Seconds a state has to hold before its interval may reach the maximum
+SAMPLING_SETTLE_SECONDS = float(os.environ.get('SAMPLING_SETTLE_SECONDS', 10))
+
+# Under full load intervals are stretched by up to this factor (1 disables)
+SAMPLING_LOAD_STRETCH = float(os.environ.get('SAMPLING_LOAD_STRETCH', 2.0))
+
+# How far each state may relax sampling; states that tend to change soon stay faster
+STATE_RELAXATION = {
+    ATTENTIVE: 1.0,
+    ABSENT: 1.0,
+    DARKNESS: 1.0,
+    SLEEPING: 0.75,
+    DROWSY: 0.5,
+    LOOKING_AWAY: 0.5
+}
+
+def state_stability(user_data, now_ms):
+    """0..1: how consistently and how long the user has held the current state"""
+    states = user_data.recent_states()
+    # A detected change still waiting for confirmation needs the next frame soon
+    if not states or user_data.current_state is None or user_data.temporal.candidate is not None:
+        return 0.0
+    agreement = states.count(user_data.current_state) / len(states)
+    dwell = min(1.0, (now_ms - user_data.state_since) / 1000.0 / SAMPLING_SETTLE_SECONDS) if SAMPLING_SETTLE_SECONDS > 0 else 1.0
+    return agreement * dwell
+
+def server_load():
+    """0..1: share of the admission limit currently in flight"""
+    if admission_controller.max_inflight <= 0:
+        return 0.0
+    return min(1.0, admission_controller.inflight / admission_controller.max_inflight)
+
+def recommend_frame_interval(user_data, confidence, now_ms):
+    """Milliseconds the client should wait before sending this user's next frame"""
+    # Below 50% confidence the state is a guess; at 90% it is as certain as detection gets
+    certainty = min(1.0, max(0.0, (confidence - 0.5) / 0.4))
+    relaxation = STATE_RELAXATION.get(user_data.current_state, 0.0)
+    score = state_stability(user_data, now_ms) * certainty * relaxation
+
+    interval = SAMPLING_MIN_INTERVAL_MS + (SAMPLING_MAX_INTERVAL_MS - SAMPLING_MIN_INTERVAL_MS) * score
+    # A busy server asks everyone to slow down, so shedding stays the exception
+    interval *= 1.0 + (SAMPLING_LOAD_STRETCH - 1.0) * server_load()
+    return int(round(interval / 50.0)) * 50
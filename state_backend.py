@@ -0,0 +1,253 @@
+import os
+import time
+import logging
+import threading
+from collections import OrderedDict
+from models import UserAttentionData, UserCalibration
+
+try:
+    import redis
+    REDIS_AVAILABLE = True
+except ImportError:
+    REDIS_AVAILABLE = False
+
+logger = logging.getLogger(__name__)
+
+# 'memory' keeps state in this process; 'redis' shares it between workers and nodes
+STATE_BACKEND = os.environ.get('STATE_BACKEND', 'memory').lower()
+REDIS_URL = os.environ.get('REDIS_URL', 'redis://localhost:6379/0')
+REDIS_KEY_PREFIX = os.environ.get('REDIS_KEY_PREFIX', 'attention:')
+
+# Shared user state expires after this many seconds without a frame (matches the in-memory cleanup)
+STATE_TTL = int(os.environ.get('STATE_TTL', 600))
+
+class StateBackend:
+    """Storage for per-user attention state and calibration"""
+
+    # Whether other processes see the same users (room aggregates are process-local)
+    shared = False
+
+    def load_user(self, user_id):
+        """Stored state for a user, or None"""
+        raise NotImplementedError
+
+    def load_users(self, user_ids):
+        """Stored state for several users, skipping unknown ones"""
+        users = {}
+        for user_id in user_ids:
+            user_data = self.load_user(user_id)
+            if user_data is not None:
+                users[user_id] = user_data
+        return users
+
+    def create_user(self, user_id):
+        """Fresh state for a user seen for the first time"""
+        return UserAttentionData(user_id)
+
+    def save_user(self, user_data):
+        raise NotImplementedError
+
+    def remove_user(self, user_id):
+        raise NotImplementedError
+
+    def expire_users(self, cutoff_time, max_users):
+        """Drop users idle since cutoff_time and the oldest beyond max_users; returns removed ids"""
+        # Shared backends expire users with TTLs instead
+        return []
+
+    def set_user_room(self, user_id, old_room_id, room_id):
+        """Move a user between room membership sets"""
+        raise NotImplementedError
+
+    def room_members(self, room_id):
+        """Ids of users last seen in a room"""
+        raise NotImplementedError
+
+    def get_calibration(self, user_id):
+        raise NotImplementedError
+
+    def set_calibration(self, user_id, calibration):
+        raise NotImplementedError
+
+    def user_count(self):
+        raise NotImplementedError
+
+    def calibration_count(self):
+        raise NotImplementedError
+
+class InMemoryStateBackend(StateBackend):
+    """Process-local dicts; the default, and the fastest with a single worker"""
+
+    def __init__(self):
+        # Kept in last-activity order (oldest first) so expiry only visits expired users
+        self.users = OrderedDict()
+        self.calibrations = {}
+        self.rooms = {}
+        self._lock = threading.Lock()
+
+    def _leave_room(self, user_data):
+        members = self.rooms.get(user_data.room_id)
+        if members is not None:
+            members.discard(user_data.user_id)
+            if not members:
+                del self.rooms[user_data.room_id]
+
+    def load_user(self, user_id):
+        return self.users.get(user_id)
+
+    def create_user(self, user_id):
+        with self._lock:
+            return self.users.setdefault(user_id, UserAttentionData(user_id))
+
+    def save_user(self, user_data):
+        # Callers mutate the stored object directly; saving only refreshes its activity order
+        with self._lock:
+            if user_data.user_id in self.users:
+                self.users.move_to_end(user_data.user_id)
+            else:
+                # Evicted while the request was in flight
+                self.users[user_data.user_id] = user_data
+
+    def remove_user(self, user_id):
+        with self._lock:
+            user_data = self.users.pop(user_id, None)
+            self.calibrations.pop(user_id, None)
+            if user_data is not None:
+                self._leave_room(user_data)
+
+    def expire_users(self, cutoff_time, max_users):
+        removed = []
+        with self._lock:
+            while self.users:
+                user_id, user_data = next(iter(self.users.items()))
+                if user_data.last_activity >= cutoff_time and len(self.users) <= max_users:
+                    break
+                del self.users[user_id]
+                self.calibrations.pop(user_id, None)
+                self._leave_room(user_data)
+                removed.append(user_id)
+        return removed
+
+    def set_user_room(self, user_id, old_room_id, room_id):
+        with self._lock:
+            members = self.rooms.get(old_room_id)
+            if members is not None:
+                members.discard(user_id)
+                if not members:
+                    del self.rooms[old_room_id]
+            if room_id is not None:
+                self.rooms.setdefault(room_id, set()).add(user_id)
+
+    def room_members(self, room_id):
+        return list(self.rooms.get(room_id, ()))
+
+    def get_calibration(self, user_id):
+        return self.calibrations.get(user_id)
+
+    def set_calibration(self, user_id, calibration):
+        self.calibrations[user_id] = calibration
+
+    def user_count(self):
+        return len(self.users)
+
+    def calibration_count(self):
+        return len(self.calibrations)
+
+class RedisStateBackend(StateBackend):
+    """State shared through Redis, so any worker or node can serve any user"""
+
+    shared = True
+
+    def __init__(self, url=REDIS_URL, prefix=REDIS_KEY_PREFIX, ttl=STATE_TTL):
+        if not REDIS_AVAILABLE:
+            raise RuntimeError("STATE_BACKEND=redis requires the redis package")
+        self.client = redis.Redis.from_url(url)
+        self.prefix = prefix
+        self.ttl = ttl
+        # Sorted sets of id -> last write time, so counts need no key scans
+        self.users_index = f'{prefix}users'
+        self.calibrations_index = f'{prefix}calibrations'
+
+    def _user_key(self, user_id):
+        return f'{self.prefix}user:{user_id}'
+
+    def _calibration_key(self, user_id):
+        return f'{self.prefix}calibration:{user_id}'
+
+    def _room_key(self, room_id):
+        return f'{self.prefix}room:{room_id}'
+
+    def load_user(self, user_id):
+        data = self.client.get(self._user_key(user_id))
+        return UserAttentionData.from_bytes(data) if data is not None else None
+
+    def load_users(self, user_ids):
+        user_ids = list(user_ids)
+        if not user_ids:
+            return {}
+        values = self.client.mget([self._user_key(user_id) for user_id in user_ids])
+        return {
+            user_id: UserAttentionData.from_bytes(data)
+            for user_id, data in zip(user_ids, values) if data is not None
+        }
+
+    def save_user(self, user_data):
+        now = time.time()
+        pipeline = self.client.pipeline(transaction=False)
+        pipeline.set(self._user_key(user_data.user_id), user_data.to_bytes(), ex=self.ttl)
+        if user_data.room_id is not None:
+            # Membership only changes on a room switch; keep the set alive as long as its members are
+            pipeline.expire(self._room_key(user_data.room_id), self.ttl)
+        pipeline.zadd(self.users_index, {user_data.user_id: now})
+        pipeline.zremrangebyscore(self.users_index, '-inf', now - self.ttl)
+        pipeline.execute()
+
+    def remove_user(self, user_id):
+        user_data = self.load_user(user_id)
+        pipeline = self.client.pipeline(transaction=False)
+        if user_data is not None and user_data.room_id is not None:
+            pipeline.srem(self._room_key(user_data.room_id), user_id)
+        pipeline.delete(self._user_key(user_id), self._calibration_key(user_id))
+        pipeline.zrem(self.users_index, user_id)
+        pipeline.zrem(self.calibrations_index, user_id)
+        pipeline.execute()
+
+    def set_user_room(self, user_id, old_room_id, room_id):
+        pipeline = self.client.pipeline(transaction=False)
+        if old_room_id is not None:
+            pipeline.srem(self._room_key(old_room_id), user_id)
+        if room_id is not None:
+            pipeline.sadd(self._room_key(room_id), user_id)
+            pipeline.expire(self._room_key(room_id), self.ttl)
+        pipeline.execute()
+
+    def room_members(self, room_id):
+        # Members whose state already expired are skipped by load_users; the set itself expires with the room
+        return [member.decode() for member in self.client.smembers(self._room_key(room_id))]
+
+    def get_calibration(self, user_id):
+        data = self.client.get(self._calibration_key(user_id))
+        return UserCalibration.from_bytes(user_id, data) if data is not None else None
+
+    def set_calibration(self, user_id, calibration):
+        now = time.time()
+        pipeline = self.client.pipeline(transaction=False)
+        pipeline.set(self._calibration_key(user_id), calibration.to_bytes(), ex=self.ttl)
+        pipeline.zadd(self.calibrations_index, {user_id: now})
+        pipeline.zremrangebyscore(self.calibrations_index, '-inf', now - self.ttl)
+        pipeline.execute()
+
+    def user_count(self):
+        return self.client.zcount(self.users_index, time.time() - self.ttl, '+inf')
+
+    def calibration_count(self):
+        return self.client.zcount(self.calibrations_index, time.time() - self.ttl, '+inf')
+
+def create_state_backend(name=STATE_BACKEND):
+    """Build the backend selected by STATE_BACKEND"""
+    if name == 'redis':
+        logger.info("Using Redis state backend at %s", REDIS_URL)
+        return RedisStateBackend()
+    if name != 'memory':
+        logger.warning("Unknown STATE_BACKEND %r, using in-memory state", name)
+    return InMemoryStateBackend()
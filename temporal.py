@@ -0,0 +1,125 @@
+import os
+import math
+from models import (
+    ATTENTIVE, LOOKING_AWAY, ABSENT, DROWSY, DARKNESS,
+    MEASUREMENT_COLUMNS, Measurement
+)
+
+# Time constant (ms) of the score EWMAs; frames arrive at uneven intervals, so weights follow elapsed time
+TEMPORAL_SMOOTHING_MS = float(os.environ.get('TEMPORAL_SMOOTHING_MS', 1500))
+
+# Filters restart from the next frame after a gap this long (ms) instead of blending stale values
+TEMPORAL_RESET_MS = float(os.environ.get('TEMPORAL_RESET_MS', 30000))
+
+# Consecutive frames a newly detected state must hold before it replaces the current one (1 disables)
+TEMPORAL_CONFIRM_FRAMES = int(os.environ.get('TEMPORAL_CONFIRM_FRAMES', 2))
+
+# PERCLOS: share of time with eyes closed over a decaying window of this many ms; an eye counts
+# as closed below TEMPORAL_EYE_CLOSED openness, and an otherwise attentive or looking-away user is
+# treated as drowsy above TEMPORAL_PERCLOS_DROWSY once at least half the window has been observed.
+# A drowsy state already current is held until PERCLOS falls below TEMPORAL_PERCLOS_RECOVER.
+TEMPORAL_PERCLOS_WINDOW_MS = float(os.environ.get('TEMPORAL_PERCLOS_WINDOW_MS', 60000))
+TEMPORAL_EYE_CLOSED = float(os.environ.get('TEMPORAL_EYE_CLOSED', 20))
+TEMPORAL_PERCLOS_DROWSY = float(os.environ.get('TEMPORAL_PERCLOS_DROWSY', 0.3))
+TEMPORAL_PERCLOS_RECOVER = float(os.environ.get('TEMPORAL_PERCLOS_RECOVER', 0.25))
+
+# PERCLOS weight reached after observing T ms is 1 - exp(-T / window), so half a window is this much
+PERCLOS_MIN_WEIGHT = 1.0 - math.exp(-0.5)
+
+TIMESTAMP_COLUMN = MEASUREMENT_COLUMNS['timestamp']
+EYE_OPENNESS_COLUMN = MEASUREMENT_COLUMNS['eye_openness']
+
+def decay(elapsed_ms, time_constant_ms):
+    """Weight left on the old value after elapsed_ms"""
+    if time_constant_ms <= 0:
+        return 0.0
+    return math.exp(-elapsed_ms / time_constant_ms)
+
+def update_filters(temporal, row):
+    """Fold a new measurement row into the score EWMAs and the PERCLOS sums"""
+    timestamp = float(row[TIMESTAMP_COLUMN])
+    scores = row[:TIMESTAMP_COLUMN]
+    elapsed_ms = (timestamp - temporal.updated_at) * 1000.0
+    closed = 1.0 if scores[EYE_OPENNESS_COLUMN] < TEMPORAL_EYE_CLOSED else 0.0
+
+    if temporal.scores is None or elapsed_ms > TEMPORAL_RESET_MS:
+        temporal.scores = scores.astype(float)
+        temporal.perclos_closed = 0.0
+        temporal.perclos_weight = 0.0
+        elapsed_ms = 0.0
+    else:
+        temporal.scores += (1.0 - decay(elapsed_ms, TEMPORAL_SMOOTHING_MS)) * (scores - temporal.scores)
+
+    # Each frame stands for the time since the previous one; a first frame gets one smoothing period
+    if elapsed_ms:
+        keep = decay(elapsed_ms, TEMPORAL_PERCLOS_WINDOW_MS)
+        share = 1.0 - keep
+    else:
+        keep = 1.0
+        share = 1.0 - decay(TEMPORAL_SMOOTHING_MS, TEMPORAL_PERCLOS_WINDOW_MS)
+    temporal.perclos_closed = temporal.perclos_closed * keep + share * closed
+    temporal.perclos_weight = temporal.perclos_weight * keep + share
+    temporal.updated_at = timestamp
+
+def get_perclos(user_data):
+    """Eye-closure ratio over the recent window, or None before any face frame"""
+    temporal = user_data.temporal
+    if temporal.perclos_weight <= 0:
+        return None
+    return temporal.perclos_closed / temporal.perclos_weight
+
+def perclos_drowsy(user_data):
+    """Whether eye closure alone keeps the user drowsy; entering and leaving use separate thresholds"""
+    temporal = user_data.temporal
+    perclos = get_perclos(user_data)
+    if perclos is None:
+        return False
+    if user_data.current_state == DROWSY:
+        # Hold the episode until the eyes have clearly been open again, so it ends in one transition
+        return perclos >= TEMPORAL_PERCLOS_RECOVER
+    return perclos >= TEMPORAL_PERCLOS_DROWSY and temporal.perclos_weight >= PERCLOS_MIN_WEIGHT
+
+def smoothed_measurement(user_data):
+    """EWMA of the user's scores as a Measurement; the latest raw one while no face is being analyzed"""
+    temporal = user_data.temporal
+    if temporal.scores is None or user_data.current_state in (ABSENT, DARKNESS):
+        return user_data.latest_measurement()
+    return Measurement(*temporal.scores.tolist(), timestamp=temporal.updated_at)
+
+def confirm_state(user_data, detected_state):
+    """Hysteresis: keep the current state until a different one is detected on enough consecutive frames"""
+    temporal = user_data.temporal
+    current_state = user_data.current_state
+
+    if current_state is None or detected_state == current_state:
+        temporal.candidate = None
+        temporal.candidate_count = 0
+        return detected_state
+
+    if detected_state == temporal.candidate:
+        temporal.candidate_count += 1
+    else:
+        temporal.candidate = detected_state
+        temporal.candidate_count = 1
+
+    if temporal.candidate_count < TEMPORAL_CONFIRM_FRAMES:
+        return current_state
+
+    temporal.candidate = None
+    temporal.candidate_count = 0
+    return detected_state
+
+def update_temporal_state(user_data, detected_state):
+    """Advance the user's filters with this frame and return the state to report"""
+    temporal = user_data.temporal
+    row = user_data.measurements.latest()
+
+    # Only frames that reached the face analysis carry eye and head scores worth smoothing
+    if (row is not None and detected_state not in (ABSENT, DARKNESS)
+            and row[TIMESTAMP_COLUMN] > temporal.updated_at):
+        update_filters(temporal, row)
+
+        if detected_state in (ATTENTIVE, LOOKING_AWAY) and perclos_drowsy(user_data):
+            detected_state = DROWSY
+
+    return confirm_state(user_data, detected_state)
@@ -1,87 +1,176 @@
+import os
 import base64
-import io
+import binascii
 import time
 import gc
-from PIL import Image
+import logging
+import threading
+from collections import OrderedDict
 import numpy as np
 import cv2
-from models import Measurement, UserAttentionData, UserCalibration, ABSENT
+from detectors import tracker_sessions
+from state_backend import create_state_backend
+from rooms import room_registry
+
+logger = logging.getLogger(__name__)
 
 # Memory management settings
 MAX_USERS = 1000
-MAX_HISTORY_ENTRIES = 20
-CLEANUP_INTERVAL = 300
+USER_IDLE_TIMEOUT = 600  # 10 minutes
 last_cleanup_time = time.time()
 
-# Global data storage
-user_attention_data = {}
-user_calibration = {}
+# Inactive users are evicted by a background janitor thread every JANITOR_INTERVAL seconds
+JANITOR_INTERVAL = float(os.environ.get('JANITOR_INTERVAL', 30))
+janitor_pid = None
+
+# Young-generation GC threshold; per-frame garbage is mostly freed by refcounting, so collect less often
+GC_GEN0_THRESHOLD = int(os.environ.get('GC_GEN0_THRESHOLD', 50000))
+
+# Frames are analyzed at a bounded working resolution; luminance stats use a smaller thumbnail
+FRAME_MAX_SIDE = int(os.environ.get('FRAME_MAX_SIDE', 640))
+LUMINANCE_MAX_SIDE = int(os.environ.get('LUMINANCE_MAX_SIDE', 160))
+
+# Per-user attention state and calibration, accessed through the functions below
+state_backend = create_state_backend()
+
+# Guards inserts/removals of per-user locks; per-user updates use user_locks.
+# Locks are kept in last-used order so idle ones can be pruned without a full scan.
+user_data_lock = threading.RLock()
+user_locks = OrderedDict()
+user_lock_times = {}
+
+def downscale_image(image, max_side, interpolation=cv2.INTER_LINEAR):
+    """Shrink an image so its longest side is at most max_side pixels"""
+    h, w = image.shape[0:2]
+    if max_side <= 0 or max(h, w) <= max_side:
+        return image
+    
+    scale = max_side / max(h, w)
+    size = (max(1, round(w * scale)), max(1, round(h * scale)))
+    return cv2.resize(image, size, interpolation=interpolation)
+
+class InvalidFrameError(ValueError):
+    """Frame data sent by the client that cannot be turned into an image"""
+
+def decode_image_bytes(image_bytes):
+    """Decode raw JPEG/PNG bytes to an OpenCV BGR image"""
+    buffer = np.frombuffer(image_bytes, dtype=np.uint8)
+    cv_image = cv2.imdecode(buffer, cv2.IMREAD_COLOR)
+    if cv_image is None:
+        raise InvalidFrameError("Could not decode image data")
+    
+    return cv_image
 
 def decode_base64_image(base64_string):
-    """Decode base64 image string to PIL and OpenCV formats"""
+    """Decode base64 image string to an OpenCV BGR image"""
     if "base64," in base64_string:
         base64_string = base64_string.split("base64,")[1]
     
-    image_bytes = base64.b64decode(base64_string)
-    pil_image = Image.open(io.BytesIO(image_bytes))
-    
-    cv_image = cv2.cvtColor(np.array(pil_image), cv2.COLOR_RGB2BGR)
-    return pil_image, cv_image
+    try:
+        image_bytes = base64.b64decode(base64_string)
+    except binascii.Error as e:
+        raise InvalidFrameError(f"Invalid base64 image data: {e}") from e
+    return decode_image_bytes(image_bytes)
+
+def decode_image_data(image_data):
+    """Decode either raw image bytes or a base64 string"""
+    if isinstance(image_data, (bytes, bytearray, memoryview)):
+        return decode_image_bytes(image_data)
+    return decode_base64_image(image_data)
+
+def get_user_lock(user_id):
+    """Get the lock serializing state updates for a single user"""
+    with user_data_lock:
+        lock = user_locks.get(user_id)
+        if lock is None:
+            lock = user_locks[user_id] = threading.Lock()
+        else:
+            user_locks.move_to_end(user_id)
+        user_lock_times[user_id] = time.time()
+    return lock
+
+def remove_user(user_id):
+    """Drop all stored state for a user"""
+    state_backend.remove_user(user_id)
+    room_registry.remove_user(user_id)
+    with user_data_lock:
+        user_locks.pop(user_id, None)
+        user_lock_times.pop(user_id, None)
+    tracker_sessions.close(user_id)
+
+def prune_user_locks(cutoff_time):
+    """Drop locks of users with no frame in this process since cutoff_time; returns their ids"""
+    pruned = []
+    with user_data_lock:
+        while user_locks:
+            user_id, lock = next(iter(user_locks.items()))
+            if user_lock_times[user_id] >= cutoff_time:
+                break
+            if lock.locked():
+                # Still serving a frame; look again once it has been idle for a full period
+                user_locks.move_to_end(user_id)
+                user_lock_times[user_id] = time.time()
+                continue
+            del user_locks[user_id]
+            del user_lock_times[user_id]
+            pruned.append(user_id)
+    return pruned
 
 def cleanup_old_data():
-    """Clean up old user data to prevent memory leaks"""
-    global user_attention_data, user_calibration, last_cleanup_time
+    """Evict inactive users; cost is proportional to the number evicted"""
+    global last_cleanup_time
     
     current_time = time.time()
-    if current_time - last_cleanup_time < CLEANUP_INTERVAL:
-        return
-    
     last_cleanup_time = current_time
+    users_removed = state_backend.expire_users(current_time - USER_IDLE_TIMEOUT, MAX_USERS)
     
-    # Remove users who haven't been active for more than 10 minutes
-    cutoff_time = current_time - 600  # 10 minutes
-    users_to_remove = []
-    
-    for user_id, user_data in user_attention_data.items():
-        last_activity = user_data.get("last_activity", 0)
-        if last_activity < cutoff_time:
-            users_to_remove.append(user_id)
-    
-    # Remove old users
-    for user_id in users_to_remove:
-        del user_attention_data[user_id]
-        if user_id in user_calibration:
-            del user_calibration[user_id]
-    
-    # If still too many users, remove oldest ones
-    if len(user_attention_data) > MAX_USERS:
-        sorted_users = sorted(
-            user_attention_data.items(),
-            key=lambda x: x[1].get("last_activity", 0)
-        )
-        users_to_remove = [user_id for user_id, _ in sorted_users[:-MAX_USERS]]
-        
-        for user_id in users_to_remove:
-            del user_attention_data[user_id]
-            if user_id in user_calibration:
-                del user_calibration[user_id]
+    with user_data_lock:
+        for user_id in users_removed:
+            # A lock still held belongs to a request that re-creates the user when it saves
+            lock = user_locks.get(user_id)
+            if lock is not None and not lock.locked():
+                del user_locks[user_id]
+                del user_lock_times[user_id]
+    # Shared backends never report removed users, so users idle in this process are also found by
+    # their locks; their process-local room records and tracking sessions go with them
+    users_idle = prune_user_locks(current_time - USER_IDLE_TIMEOUT)
     
-    # Limit history entries for all users
-    for user_id in user_attention_data:
-        if "history" in user_attention_data[user_id] and len(user_attention_data[user_id]["history"]) > MAX_HISTORY_ENTRIES:
-            user_attention_data[user_id]["history"] = user_attention_data[user_id]["history"][-MAX_HISTORY_ENTRIES:]
-        
-        # Limit measurements history
-        if "measurements" in user_attention_data[user_id]:
-            measurements = user_attention_data[user_id]["measurements"]
-            if hasattr(measurements, '__len__') and len(measurements) > 10:
-                user_attention_data[user_id]["measurements"] = list(measurements)[-10:]
+    for user_id in users_removed + users_idle:
+        room_registry.remove_user(user_id)
+        tracker_sessions.close(user_id)
+    tracker_sessions.expire_idle()
     
-    # Force garbage collection
+    if users_removed:
+        logger.info("Cleaned up %d inactive users. Current users: %d", len(users_removed), state_backend.user_count())
+
+def _run_janitor():
+    while True:
+        time.sleep(JANITOR_INTERVAL)
+        try:
+            cleanup_old_data()
+        except Exception:
+            logger.exception("Janitor cleanup failed")
+
+def start_janitor():
+    """Start the cleanup thread in this process; threads do not survive a fork"""
+    global janitor_pid
+    if janitor_pid == os.getpid():
+        return
+    with user_data_lock:
+        if janitor_pid == os.getpid():
+            return
+        janitor_pid = os.getpid()
+        threading.Thread(target=_run_janitor, name='state-janitor', daemon=True).start()
+
+def tune_gc():
+    """Raise the young-generation threshold so full collections stay rare on the request path"""
+    _, gen1, gen2 = gc.get_threshold()
+    gc.set_threshold(GC_GEN0_THRESHOLD, gen1, gen2)
+
+def freeze_gc():
+    """Move long-lived startup objects (models, modules) out of future collections"""
     gc.collect()
-    
-    if users_to_remove:
-        print(f"Cleaned up {len(users_to_remove)} inactive users. Current users: {len(user_attention_data)}")
+    gc.freeze()
 
 def get_attention_state_confidence(measurements, current_state, user_id):
     """Calculate confidence score for attention state detection"""
@@ -92,10 +181,10 @@ def get_attention_state_confidence(measurements, current_state, user_id):
     latest_measurement = measurements[-1]
     
     # Calculate confidence based on current snapshot quality
-    face_presence = latest_measurement.get('face_presence', 0)
-    eye_openness = latest_measurement.get('eye_openness', 0)
-    looking_score = latest_measurement.get('looking_score', 0)
-    brightness = latest_measurement.get('brightness', 0)
+    face_presence = latest_measurement.face_presence
+    eye_openness = latest_measurement.eye_openness
+    looking_score = latest_measurement.looking_score
+    brightness = latest_measurement.brightness
     
     # Base confidence
     confidence = 0.5
@@ -131,49 +220,12 @@ def get_attention_state_confidence(measurements, current_state, user_id):
     
     return min(1.0, max(0.3, confidence))  # Clamp between 0.3 and 1.0
 
-def update_attention_history(user_id, attention_state):
+def update_attention_history(user_data, attention_state):
     """Update user attention history with new state"""
     current_time = int(time.time() * 1000)
     
-    # Clean up old data periodically
-    cleanup_old_data()
-    
-    if user_id not in user_attention_data:
-        user_attention_data[user_id] = {
-            "current_state": attention_state,
-            "state_since": current_time,
-            "history": [],
-            "last_activity": time.time()
-        }
-    else:
-        # Update last activity
-        user_attention_data[user_id]["last_activity"] = time.time()
-        
-        if user_attention_data[user_id].get("current_state") != attention_state:
-            prev_state = user_attention_data[user_id].get("current_state")
-            prev_since = user_attention_data[user_id].get("state_since", current_time)
-            
-            duration = (current_time - prev_since) / 1000.0
-            
-            if duration > 1:
-                if "history" not in user_attention_data[user_id]:
-                    user_attention_data[user_id]["history"] = []
-                
-                user_attention_data[user_id]["history"].append({
-                    "state": prev_state,
-                    "start_time": prev_since,
-                    "end_time": current_time,
-                    "duration": duration
-                })
-            
-            user_attention_data[user_id]["current_state"] = attention_state
-            user_attention_data[user_id]["state_since"] = current_time
-    
-    # Limit history entries using the new constant
-    if "history" in user_attention_data[user_id] and len(user_attention_data[user_id]["history"]) > MAX_HISTORY_ENTRIES:
-        user_attention_data[user_id]["history"] = user_attention_data[user_id]["history"][-MAX_HISTORY_ENTRIES:]
-    
-    return user_attention_data[user_id]
+    user_data.record_state(attention_state, current_time)
+    return user_data
 
 def get_attention_percentage(attention_state):
     """Convert attention state to percentage score"""
@@ -194,20 +246,52 @@ def get_attention_percentage(attention_state):
         return 0
 
 def get_user_attention_data(user_id):
-    """Get or create user attention data"""
-    if user_id not in user_attention_data:
-        user_attention_data[user_id] = {
-            'measurements': [],
-            'state_history': [],
-            'calibration_images': [],
-            'last_activity': time.time()
-        }
-    return user_attention_data[user_id]
+    """Get or create user attention data; changes must be stored with save_user_attention_data"""
+    start_janitor()
+    user_data = state_backend.load_user(user_id)
+    if user_data is None:
+        user_data = state_backend.create_user(user_id)
+    return user_data
+
+def find_user_attention_data(user_id):
+    """Read-only lookup; returns None for unknown users instead of creating them"""
+    return state_backend.load_user(user_id)
+
+def find_users_attention_data(user_ids):
+    """Read-only lookup of several users; unknown ids are left out"""
+    return state_backend.load_users(user_ids)
+
+def set_user_room(user_data, room_id):
+    """Record the room a user's frames are coming from"""
+    if room_id is None or user_data.room_id == room_id:
+        return
+    state_backend.set_user_room(user_data.user_id, user_data.room_id, room_id)
+    user_data.room_id = room_id
+
+def is_state_shared():
+    """Whether user state is shared with other processes"""
+    return state_backend.shared
+
+def get_room_member_ids(room_id):
+    """Ids of users whose latest frames named this room"""
+    return state_backend.room_members(room_id)
+
+def save_user_attention_data(user_data):
+    """Store updated user attention data (a no-op for the in-memory backend)"""
+    state_backend.save_user(user_data)
+
+def get_user_count():
+    """Number of users with stored attention data"""
+    return state_backend.user_count()
+
+def get_calibration_count():
+    """Number of calibrated users"""
+    return state_backend.calibration_count()
 
 def get_user_calibration(user_id):
     """Get user calibration data"""
-    return user_calibration.get(user_id)
+    return state_backend.get_calibration(user_id)
 
 def set_user_calibration(user_id, calibration_data):
     """Set user calibration data"""
-    user_calibration[user_id] = calibration_data 
\ No newline at end of file
+    state_backend.set_calibration(user_id, calibration_data)